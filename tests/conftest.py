@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The scripts of utils/ are run in place, not installed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "utils"))
@@ -0,0 +1,339 @@
+import os
+import sys
+import json
+import hashlib
+import threading
+import subprocess
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import deploy
+
+DEPLOY = os.path.join(os.path.dirname(os.path.dirname(__file__)), "utils", "deploy.py")
+SHA256_DIR = os.path.join(os.path.dirname(DEPLOY), "sha256")
+
+IMAGE_IDS = {
+    "v2fly/v2fly-core:v5.16.1": "sha256:v2fly",
+    "teddysun/xray:25.7.26": "sha256:xray",
+    "tobyxdd/hysteria:v2.6.2": "sha256:hysteria",
+}
+
+
+class FakeDocker(ThreadingHTTPServer):
+    """
+    The Docker Engine API endpoints deploy.py calls, answering pretty-printed
+    JSON like a proxy in front of the daemon may
+    """
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), FakeDockerHandler)
+        self.images = {}
+        self.containers = {}
+        self.calls = []
+        self.pull_error = None
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=None, stream=False):
+        if body is None:
+            data = b""
+        elif stream:
+            data = b"".join(json.dumps(x).encode() + b"\r\n" for x in body)
+        else:
+            data = json.dumps(body, indent=2).encode()
+        self.send_response(status)
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def handle_any(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        query = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        docker = self.server
+
+        with docker.lock:
+            docker.calls.append((method, url.path))
+            parts = url.path.strip("/").split("/")
+
+            if url.path == "/images/create":
+                image = f"{query['fromImage']}:{query['tag']}"
+                if docker.pull_error:
+                    return self.reply(
+                        200, [{"status": "Pulling"}, {"error": docker.pull_error}], True
+                    )
+                docker.images[image] = IMAGE_IDS[image]
+                return self.reply(
+                    200, [{"status": "Pulling"}, {"status": "Done"}], True
+                )
+            if url.path == "/images/load":
+                docker.images["teddysun/xray:25.7.26"] = IMAGE_IDS[
+                    "teddysun/xray:25.7.26"
+                ]
+                return self.reply(200, [{"stream": "Loaded image"}], True)
+            if parts[0] == "images":
+                image = "/".join(parts[1:-1])
+                if image not in docker.images:
+                    return self.reply(404, {"message": f"No such image: {image}"})
+                return self.reply(200, {"Id": docker.images[image]})
+
+            if url.path == "/containers/create":
+                spec = json.loads(body)
+                if query["name"] in docker.containers:
+                    return self.reply(409, {"message": "Conflict"})
+                docker.containers[query["name"]] = {
+                    "Id": hashlib.sha256(query["name"].encode()).hexdigest(),
+                    "Name": query["name"],
+                    "Image": docker.images[spec["Image"]],
+                    "Config": {"Labels": spec.get("Labels"), "Cmd": spec.get("Cmd")},
+                    "HostConfig": spec["HostConfig"],
+                    "State": {"Status": "created", "Running": False},
+                }
+                return self.reply(201, {"Id": docker.containers[query["name"]]["Id"]})
+
+            container = docker.containers.get(parts[1])
+            if container is None:
+                return self.reply(404, {"message": f"No such container: {parts[1]}"})
+            if method == "GET":
+                return self.reply(200, container)
+            if parts[-1] == "start":
+                broken = "broken" in container["Name"]
+                container["State"] = {
+                    "Status": "exited" if broken else "running",
+                    "Running": not broken,
+                    "ExitCode": 1 if broken else 0,
+                }
+                return self.reply(204)
+            if parts[-1] == "stop":
+                running = container["State"]["Running"]
+                container["State"] = {"Status": "exited", "Running": False}
+                return self.reply(204 if running else 304)
+            del docker.containers[container["Name"]]
+            return self.reply(204)
+
+    def do_GET(self):
+        self.handle_any("GET")
+
+    def do_POST(self):
+        self.handle_any("POST")
+
+    def do_DELETE(self):
+        self.handle_any("DELETE")
+
+
+@pytest.fixture
+def docker():
+    server = FakeDocker()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def host(tmp_path):
+    """
+    Pins, image tars and the directories deploy.py works in
+    """
+    for name in ("configs", "etc", "images", "sha256"):
+        (tmp_path / name).mkdir()
+    for name, image in zip(("v2fly", "xray", "hysteria"), IMAGE_IDS):
+        (tmp_path / "sha256" / f"{name}.sha256").write_text(
+            f"{image} {IMAGE_IDS[image]}\n"
+        )
+    (tmp_path / "images" / "xray.tar").write_bytes(b"tar")
+    return tmp_path
+
+
+def write_bundle(host, clusters, sidecars=(), changed=()):
+    manifest = {"clusters": []}
+    for client, country, port in clusters:
+        data = json.dumps({"country": country, "changed": country in changed}).encode()
+        (host / "configs" / f"config_{country}.json").write_bytes(data)
+        entry = {"client": client, "country": country, "port": port}
+        entry["sha256"] = hashlib.sha256(data).hexdigest()
+        if country in sidecars:
+            sidecar = json.dumps({"server": country}).encode()
+            (host / "configs" / f"config_{country}.hysteria2.json").write_bytes(sidecar)
+            entry["sidecar_sha256"] = hashlib.sha256(sidecar).hexdigest()
+        manifest["clusters"].append(entry)
+
+    path = host / "configs" / "manifest.json"
+    path.write_text(json.dumps(manifest))
+    return path
+
+
+def run(docker, host, manifest, *args):
+    return subprocess.run(
+        [
+            sys.executable,
+            DEPLOY,
+            str(manifest),
+            "--docker",
+            docker.url,
+            "--config_dir",
+            str(host / "etc"),
+            "--images",
+            str(host / "images"),
+            "--sha256",
+            str(host / "sha256"),
+            "--settle",
+            "0.05",
+            *args,
+        ],
+        capture_output=True,
+        text=True,
+        timeout=60,
+    )
+
+
+CLUSTERS = [("v2fly", "hk", 30000), ("xray", "jp", 30010), ("v2fly", "hy", 30020)]
+
+
+def test_deploy_then_unchanged(docker, host):
+    docker.images["v2fly/v2fly-core:v5.16.1"] = IMAGE_IDS["v2fly/v2fly-core:v5.16.1"]
+
+    result = run(docker, host, write_bundle(host, CLUSTERS, ["hy"]), "-j", "3")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "changed: 3," in result.stdout
+    assert set(docker.containers) == {
+        "proxy-hk",
+        "proxy-jp",
+        "proxy-hy",
+        "proxy-hy-hysteria2",
+    }
+    assert ("POST", "/images/load") in docker.calls
+    assert ("POST", "/images/create") in docker.calls
+
+    jp = docker.containers["proxy-jp"]
+    assert jp["HostConfig"]["PortBindings"]["30011/tcp"] == [{"HostPort": "30011"}]
+    assert jp["HostConfig"]["Binds"] == [
+        f"{host}/etc/xray/config_jp.json:/etc/xray/config.json"
+    ]
+    sidecar = docker.containers["proxy-hy-hysteria2"]
+    assert (
+        sidecar["HostConfig"]["NetworkMode"]
+        == f"container:{docker.containers['proxy-hy']['Id']}"
+    )
+
+    result = run(docker, host, write_bundle(host, CLUSTERS, ["hy"]))
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "changed: 0," in result.stdout
+    assert result.stdout.count("unchanged") == 4
+
+
+def test_only_changed_config_is_recreated(docker, host):
+    run(docker, host, write_bundle(host, CLUSTERS))
+    before = {name: c["Config"]["Labels"] for name, c in docker.containers.items()}
+    docker.calls.clear()
+
+    manifest = write_bundle(host, CLUSTERS, changed=["hk"])
+    result = run(docker, host, manifest)
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert "proxy-hk: recreated" in result.stdout
+    assert "changed: 1," in result.stdout
+    assert docker.containers["proxy-jp"]["Config"]["Labels"] == before["proxy-jp"]
+    assert ("POST", "/containers/proxy-jp/stop") not in docker.calls
+
+
+def test_failed_health_gate_stops_the_rollout(docker, host):
+    clusters = [
+        ("v2fly", "broken", 30000),
+        ("v2fly", "a", 30010),
+        ("v2fly", "b", 30020),
+    ]
+
+    result = run(docker, host, write_bundle(host, clusters), "-j", "1")
+    assert result.returncode == 1
+    assert "proxy-broken: \033[1;31mfailed\033[0m exited with code 1" in result.stdout
+    assert "skipped: 2" in result.stdout
+    assert set(docker.containers) == {"proxy-broken"}
+
+
+def test_damaged_bundle_is_rejected(docker, host):
+    manifest = write_bundle(host, CLUSTERS)
+    (host / "configs" / "config_jp.json").write_text("{}")
+
+    result = run(docker, host, manifest)
+    assert result.returncode == 1
+    assert "config_jp.json: sha256 does not match the manifest" in result.stdout
+    assert docker.calls == []
+
+
+def test_unpinned_image_is_refused(docker, host):
+    (host / "sha256" / "v2fly.sha256").write_text(
+        "v2fly/v2fly-core:v5.16.1 sha256:other\n"
+    )
+
+    result = run(docker, host, write_bundle(host, CLUSTERS[:1]))
+    assert result.returncode == 1
+    assert "v2fly/v2fly-core:v5.16.1 is not valid" in result.stdout
+    assert docker.containers == {}
+
+
+def test_unavailable_sidecar_only_fails_its_clusters(docker, host):
+    (host / "sha256" / "hysteria.sha256").write_text("tobyxdd/hysteria:v2.6.2\n")
+
+    result = run(docker, host, write_bundle(host, CLUSTERS, ["hy"]), "-j", "1")
+    assert result.returncode == 1
+    assert "proxy-hy: \033[1;31mfailed\033[0m hysteria.sha256 pins no image ID" in (
+        result.stdout
+    )
+    assert "failed: 1, skipped: 0" in result.stdout
+    assert set(docker.containers) == {"proxy-hk", "proxy-jp"}
+
+
+def test_repo_pins(docker, host):
+    clients = deploy.load_clients(SHA256_DIR)
+    for name, client in deploy.CLIENTS.items():
+        assert clients[name]["image"] == client["image"]
+        assert clients[name]["image_id"] == client["image_id"]
+    assert clients[deploy.SIDECAR_NAME]["image"] == deploy.SIDECAR["image"]
+
+    for client in clients.values():
+        if client["image_id"]:
+            docker.images[client["image"]] = client["image_id"]
+
+    manifest = write_bundle(host, CLUSTERS, ["hy"])
+    result = run(docker, host, manifest, "--sha256", SHA256_DIR)
+    assert "proxy-hk: recreated" in result.stdout
+    assert "proxy-jp: recreated" in result.stdout
+    if clients[deploy.SIDECAR_NAME]["image_id"]:
+        assert result.returncode == 0, result.stdout + result.stderr
+        assert "proxy-hy-hysteria2" in docker.containers
+    else:
+        assert result.returncode == 1
+        assert "hysteria.sha256 pins no image ID" in result.stdout
+        assert "proxy-hy" not in docker.containers
+
+
+def test_turn_off(docker, host):
+    run(docker, host, write_bundle(host, CLUSTERS, ["hy"]))
+
+    result = run(docker, host, write_bundle(host, CLUSTERS), "--status", "off")
+    assert result.returncode == 0, result.stdout + result.stderr
+    assert docker.containers == {}
+    assert not any(path.is_file() for path in (host / "etc").rglob("*"))
+
+
+def test_stream_errors_are_raised(docker):
+    docker.pull_error = "manifest unknown"
+    client = deploy.DockerClient(docker.url)
+
+    with pytest.raises(deploy.DockerError, match="manifest unknown"):
+        client.pull_image("tobyxdd/hysteria:v2.6.2")
+    assert client.inspect_image("tobyxdd/hysteria:v2.6.2") is None
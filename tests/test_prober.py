@@ -0,0 +1,130 @@
+import ssl
+import sys
+import shutil
+import asyncio
+import subprocess
+
+import pytest
+
+import prober
+from v2builder import ServerProtocolA, ServerProtocolC, ServerProtocolD
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is required to make the test certificate")
+
+    path = tmp_path_factory.mktemp("tls")
+    cert, key = path / "cert.pem", path / "key.pem"
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+        + ["-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost"]
+        + ["-keyout", str(key), "-out", str(cert)],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+async def listen(ssl_context=None):
+    """
+    A local stand-in server, the TLS one completes the handshake
+    """
+
+    async def handle(reader, writer):
+        try:
+            await reader.read(1)
+        except (ConnectionError, ssl.SSLError):
+            pass
+        writer.close()
+
+    return await asyncio.start_server(handle, "127.0.0.1", 0, ssl=ssl_context)
+
+
+def server(protocol, port, **fields):
+    return {
+        "id": "test",
+        "protocol": protocol,
+        "addr": "127.0.0.1",
+        "port": str(port),
+        "note": protocol,
+        **fields,
+    }
+
+
+def test_tcp_probe():
+    async def main():
+        listener = await listen()
+        async with listener:
+            port = listener.sockets[0].getsockname()[1]
+            return await prober.probe_server(server(ServerProtocolA.NAME, port), 2, 2.0)
+
+    result = asyncio.run(main())
+    assert result["loss"] == 0
+    assert result["tcp_ms"] is not None
+    assert result["tls_ms"] is None
+    assert "error" not in result
+
+
+def test_tls_probe_with_injected_context(certificate):
+    cert, key = certificate
+    server_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    server_context.load_cert_chain(cert, key)
+
+    # Verifying against the test certificate proves the context is used
+    client_context = ssl.create_default_context(cafile=str(cert))
+
+    async def main():
+        listener = await listen(server_context)
+        async with listener:
+            port = listener.sockets[0].getsockname()[1]
+            trojan = server(ServerProtocolC.NAME, port, sni="localhost")
+            good = await prober.probe_server(trojan, 2, 2.0, client_context)
+            trojan = server(ServerProtocolC.NAME, port, sni="other.example.com")
+            bad = await prober.probe_server(trojan, 2, 2.0, client_context)
+            return good, bad
+
+    good, bad = asyncio.run(main())
+    assert good["loss"] == 0
+    assert good["tls_ms"] is not None
+    assert bad["loss"] == 1.0
+    assert bad["tls_ms"] is None
+    assert "SSL" in bad["error"]
+
+
+def test_closed_port_is_lost():
+    async def main():
+        listener = await listen()
+        port = listener.sockets[0].getsockname()[1]
+        listener.close()
+        await listener.wait_closed()
+        return await prober.probe_server(server(ServerProtocolA.NAME, port), 2, 2.0)
+
+    result = asyncio.run(main())
+    assert result["loss"] == 1.0
+    assert result["tcp_ms"] is None
+    assert result["error"]
+
+
+def test_udp_protocols_are_not_probed():
+    result = asyncio.run(prober.probe_server(server(ServerProtocolD.NAME, 1), 2, 2.0))
+    assert result["error"] == "udp"
+    assert result["loss"] is None
+
+
+def test_rank():
+    results = [
+        {"tcp_ms": None, "tls_ms": None, "loss": 1.0},
+        {"tcp_ms": 30.0, "tls_ms": 20.0, "loss": 0.0},
+        {"tcp_ms": 10.0, "tls_ms": None, "loss": 0.5},
+        {"tcp_ms": 40.0, "tls_ms": None, "loss": 0.0},
+    ]
+    assert prober.rank(results) == [results[3], results[1], results[2], results[0]]
+
+
+@pytest.mark.parametrize("option", ["--parallel", "--attempts"])
+def test_options_must_be_positive(monkeypatch, option):
+    monkeypatch.setattr(sys, "argv", ["prober.py", "-c", ".", option, "0"])
+    with pytest.raises(SystemExit):
+        prober.args_parse()
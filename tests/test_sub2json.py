@@ -0,0 +1,196 @@
+import os
+import json
+import base64
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import sub2json
+
+TROJAN = sub2json.ProtocolC.NAME
+
+
+def trojan(host, note):
+    return f"{TROJAN}password@{host}:443?sni={host}#{note}"
+
+
+def subscription(*links):
+    return base64.b64encode("\n".join(links).encode("utf-8"))
+
+
+class Provider(ThreadingHTTPServer):
+    """
+    Subscription providers, each path answers its body with an optional
+    ETag and 304 once the client sends that ETag back
+    """
+
+    def __init__(self) -> None:
+        super().__init__(("127.0.0.1", 0), ProviderHandler)
+        self.bodies = {}
+        self.etags = {}
+        self.requests = []
+        self.barrier = None
+        self.lock = threading.Lock()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server_address[1]}{path}"
+
+
+class ProviderHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        provider = self.server
+        with provider.lock:
+            provider.requests.append((self.path, self.headers.get("If-None-Match")))
+
+        if provider.barrier is not None:
+            try:
+                provider.barrier.wait()
+            except threading.BrokenBarrierError:
+                self.send_response(503)
+                self.end_headers()
+                return
+
+        etag = provider.etags.get(self.path)
+        if etag is not None and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        body = provider.bodies[self.path]
+        self.send_response(200)
+        if etag is not None:
+            self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def provider():
+    server = Provider()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def source(provider, tmp_path, name, *links, etag=None):
+    path = f"/{name}"
+    provider.bodies[path] = subscription(*links)
+    if etag is not None:
+        provider.etags[path] = etag
+    return {"name": name, "url": provider.url(path), "dir": str(tmp_path / name)}
+
+
+def written(source):
+    """
+    {addr: serverNN.json} of the server files of a source
+    """
+    servers = {}
+    for name in sorted(os.listdir(source["dir"])):
+        if sub2json.SERVER_FILE_PATTERN.fullmatch(name):
+            with open(os.path.join(source["dir"], name), "r", encoding="utf-8") as f:
+                servers[json.load(f)["addr"]] = name
+    return servers
+
+
+def test_sources_are_fetched_concurrently(provider, tmp_path):
+    sources = [
+        source(provider, tmp_path, f"p{i}", trojan(f"h{i}.example.com", f"HK {i}"))
+        for i in range(3)
+    ]
+    # Every fetch has to be in flight at once to get past the barrier
+    provider.barrier = threading.Barrier(len(sources), timeout=5)
+
+    assert sub2json.convert_all(sources, jobs=len(sources)) == []
+    for i, item in enumerate(sources):
+        assert list(written(item)) == [f"h{i}.example.com"]
+
+
+def test_etag_304_skips_the_conversion(provider, tmp_path, capsys):
+    sources = [
+        source(provider, tmp_path, "p", trojan("h.example.com", "HK"), etag='"v1"')
+    ]
+
+    assert sub2json.convert_all(sources) == []
+    assert sub2json.convert_all(sources) == []
+    assert provider.requests == [("/p", None), ("/p", '"v1"')]
+    assert "Subscription \033[1;32mp\033[0m is unchanged, skipped" in (
+        capsys.readouterr().out
+    )
+
+
+def test_identical_body_skips_the_conversion(provider, tmp_path, capsys):
+    sources = [source(provider, tmp_path, "p", trojan("h.example.com", "HK"))]
+
+    assert sub2json.convert_all(sources) == []
+    capsys.readouterr()
+    assert sub2json.convert_all(sources) == []
+    out = capsys.readouterr().out
+    assert "Subscription \033[1;32mp\033[0m is unchanged, skipped" in out
+    assert "Converting" not in out
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        subscription(f"{TROJAN}malformed"),
+        base64.b64encode(b"\xff\xfe\xfd"),
+    ],
+    ids=["malformed link", "not utf-8"],
+)
+def test_bad_source_does_not_stop_the_others(provider, tmp_path, body):
+    sources = [
+        source(provider, tmp_path, "good", trojan("h1.example.com", "HK")),
+        source(provider, tmp_path, "bad", trojan("h2.example.com", "JP")),
+        source(provider, tmp_path, "other", trojan("h3.example.com", "US")),
+    ]
+    provider.bodies["/bad"] = body
+
+    assert sub2json.convert_all(sources) == ["bad"]
+    assert list(written(sources[0])) == ["h1.example.com"]
+    assert list(written(sources[2])) == ["h3.example.com"]
+    assert not (tmp_path / "bad").exists()
+
+
+def test_invalid_base64_raises_value_error():
+    with pytest.raises(ValueError, match="Invalid subscription data"):
+        sub2json.Sub2Json(base64.b64encode(b"\xff\xfe\xfd")).decode()
+
+
+def test_duplicates_stay_with_the_first_source(provider, tmp_path):
+    shared = trojan("shared.example.com", "HK shared")
+    sources = [
+        source(provider, tmp_path, "first", shared, trojan("a.example.com", "HK")),
+        source(provider, tmp_path, "second", trojan("b.example.com", "JP"), shared),
+    ]
+
+    assert sub2json.convert_all(sources) == []
+    assert set(written(sources[0])) == {"shared.example.com", "a.example.com"}
+    assert set(written(sources[1])) == {"b.example.com"}
+
+    # Once the first provider drops it, the second one keeps its copy
+    provider.bodies["/first"] = subscription(trojan("a.example.com", "HK"))
+    assert sub2json.convert_all(sources) == []
+    assert set(written(sources[0])) == {"a.example.com"}
+    assert set(written(sources[1])) == {"b.example.com", "shared.example.com"}
+
+
+def test_hysteria2_obfs_tells_servers_apart():
+    link = f"{sub2json.ProtocolD.NAME}password@hy.example.com:8443?sni=hy.example.com"
+    servers = sub2json.Sub2Json(
+        subscription(
+            f"{link}#plain",
+            f"{link}&obfs=salamander&obfs-password=one#one",
+            f"{link}&obfs=salamander&obfs-password=two#two",
+            f"{link}&obfs=salamander&obfs-password=two#copy",
+        )
+    ).decode()
+
+    notes = [server["note"] for server in sub2json.dedup_dicts(servers)]
+    assert notes == ["plain", "one", "two"]
@@ -0,0 +1,378 @@
+import json
+import threading
+
+import pytest
+
+import v2builder
+from v2builder import (
+    BuildOptions,
+    ConfigTemplate,
+    ServerProtocolA,
+    ServerProtocolB,
+    ServerProtocolC,
+    ServerProtocolD,
+    ServerProtocolE,
+)
+
+SERVERS = {
+    "shadowsocks": {
+        "protocol": ServerProtocolA.NAME,
+        "addr": "ss.example.com",
+        "port": "8388",
+        "uuid": "password",
+        "method": "aes-256-gcm",
+        "note": "ss",
+    },
+    "vmess": {
+        "protocol": ServerProtocolB.NAME,
+        "addr": "vmess.example.com",
+        "port": "443",
+        "uuid": "00000000-0000-4000-8000-000000000001",
+        "note": "vmess",
+    },
+    "trojan": {
+        "protocol": ServerProtocolC.NAME,
+        "addr": "trojan.example.com",
+        "port": "443",
+        "uuid": "password",
+        "sni": "trojan.example.com",
+        "allowInsecure": False,
+        "note": "trojan",
+    },
+    "hysteria2": {
+        "protocol": ServerProtocolD.NAME,
+        "addr": "hy.example.com",
+        "port": "8443",
+        "uuid": "password",
+        "sni": "hy.example.com",
+        "note": "hysteria2",
+    },
+    "vless": {
+        "protocol": ServerProtocolE.NAME,
+        "addr": "vless.example.com",
+        "port": "443",
+        "uuid": "00000000-0000-4000-8000-000000000002",
+        "type": ["ws"],
+        "security": ["tls"],
+        "sni": ["vless.example.com"],
+        "note": "vless",
+    },
+    "vless-vision": {
+        "protocol": ServerProtocolE.NAME,
+        "addr": "vision.example.com",
+        "port": "443",
+        "uuid": "00000000-0000-4000-8000-000000000003",
+        "flow": ["xtls-rprx-vision"],
+        "security": ["tls"],
+        "sni": ["vision.example.com"],
+        "note": "vless vision",
+    },
+    "vless-reality": {
+        "protocol": ServerProtocolE.NAME,
+        "addr": "reality.example.com",
+        "port": "443",
+        "uuid": "00000000-0000-4000-8000-000000000004",
+        "type": ["grpc"],
+        "serviceName": ["grpc"],
+        "security": ["reality"],
+        "sni": ["www.apple.com"],
+        "fp": ["chrome"],
+        "pbk": ["publickey"],
+        "sid": ["01ab"],
+        "note": "vless reality",
+    },
+}
+
+
+@pytest.fixture(scope="module")
+def template(tmp_path_factory):
+    # Keep the builder away from the user's ~/.v2rules.json
+    path = tmp_path_factory.mktemp("rules") / "v2rules.json"
+    v2builder.GLOBAL_RULES_PATH = str(path)
+    return ConfigTemplate(v2builder.load_routing(), True)
+
+
+def proxy_outbound(template, name, mux, client="v2fly"):
+    options = BuildOptions(client=client, mux=mux)
+    config = json.loads(template.render(SERVERS[name], 30000, options))
+    assert v2builder.validate_config(config) == []
+    return next(x for x in config["outbounds"] if x["tag"] == "proxy")
+
+
+@pytest.mark.parametrize("name", ["vmess", "trojan", "vless"])
+def test_mux_is_emitted(template, name):
+    outbound = proxy_outbound(template, name, 8)
+    assert outbound["mux"]["enabled"] is True
+    assert outbound["mux"]["concurrency"] == 8
+
+
+# Shadowsocks servers are mostly ss-libev/ss-rust, which do not speak mux.cool
+@pytest.mark.parametrize(
+    "name", ["shadowsocks", "vless-vision", "vless-reality", "hysteria2"]
+)
+def test_mux_is_skipped(template, name):
+    for client in ("v2fly", "xray"):
+        assert "mux" not in proxy_outbound(template, name, 8, client)
+
+
+@pytest.mark.parametrize("name", list(SERVERS))
+def test_mux_off_by_default(template, name):
+    assert "mux" not in proxy_outbound(template, name, 0)
+
+
+@pytest.mark.parametrize("name", ["vmess", "vless"])
+def test_xudp_only_on_xray(template, name):
+    assert "xudpConcurrency" not in proxy_outbound(template, name, 8)["mux"]
+    assert proxy_outbound(template, name, 8, "xray")["mux"]["xudpConcurrency"] == 8
+
+
+@pytest.mark.parametrize("name", ["trojan"])
+def test_no_xudp_without_vless_or_vmess(template, name):
+    assert "xudpConcurrency" not in proxy_outbound(template, name, 8, "xray")["mux"]
+
+
+def test_compiled_routing_is_not_shared_mutably(template):
+    routing = v2builder.load_routing()
+    before = routing.to_dict()
+
+    with pytest.raises(TypeError):
+        routing.rules[0]["outboundTag"] = "block"
+
+    copy = routing.to_dict()
+    copy["rules"][0]["outboundTag"] = "block"
+    copy["rules"][-1]["port"] = "0"
+    next(r for r in copy["rules"] if "domain" in r)["domain"].append("x.com")
+
+    assert v2builder.load_routing().to_dict() == before
+
+
+# Server lists and options of every config shape ConfigTemplate renders
+SHAPES = {
+    "single": (False, BuildOptions()),
+    "xray mux": (False, BuildOptions(client="xray", mux=8)),
+    "dns": (False, BuildOptions(dns=v2builder.DnsOptions())),
+    "balanced": (True, BuildOptions(balancer=v2builder.Balancer("random"))),
+    "balanced dns": (
+        True,
+        BuildOptions(client="xray", dns=v2builder.DnsOptions(strategy="UseIP")),
+    ),
+}
+
+
+@pytest.mark.parametrize("compact", [False, True], ids=["indent", "compact"])
+@pytest.mark.parametrize("allow_lan", [True, False], ids=["lan", "loopback"])
+@pytest.mark.parametrize("shape", list(SHAPES))
+@pytest.mark.parametrize("name", list(SERVERS))
+def test_template_matches_build_config(template, name, shape, allow_lan, compact):
+    balanced, options = SHAPES[shape]
+    server = SERVERS[name]
+    if balanced:
+        other = "trojan" if name == "vmess" else "vmess"
+        server = [server, SERVERS[other]]
+
+    routing = v2builder.load_routing()
+    rendered = ConfigTemplate(routing, allow_lan, compact).render(
+        server, 30000, options
+    )
+    built = v2builder.build_config(server, 30000, allow_lan, routing, options)
+    assert rendered == v2builder.dump_config(built, compact)
+
+
+def write_servers(tmp_path, *servers):
+    paths = []
+    for i, server in enumerate(servers, 1):
+        path = tmp_path / f"server{i:02d}.json"
+        path.write_text(json.dumps(server))
+        paths.append(str(path))
+    return paths
+
+
+def build_invalid(tmp_path, capsys, clusters):
+    """
+    Output of a --clusters build that has to be rejected before any write
+    """
+    outdir = tmp_path / "configs"
+    with pytest.raises(SystemExit) as e:
+        v2builder.build_clusters(clusters, str(outdir))
+    assert e.value.code == 1
+    assert not outdir.exists()
+    return capsys.readouterr().out
+
+
+def test_two_hysteria2_servers_are_reported(template, tmp_path, capsys):
+    other = dict(SERVERS["hysteria2"], addr="hy2.example.com")
+    files = write_servers(tmp_path, SERVERS["hysteria2"], other)
+
+    out = build_invalid(
+        tmp_path, capsys, [{"country": "hy", "port": 30000, "files": files}]
+    )
+    assert "2 hysteria2 servers share the one hysteria2 sidecar" in out
+
+
+class FakeResolve:
+    """
+    resolve callable of AddressResolver, counts the lookups of every host
+    """
+
+    def __init__(self, addresses) -> None:
+        self.addresses = addresses
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, host):
+        with self.lock:
+            self.calls[host] = self.calls.get(host, 0) + 1
+        if host not in self.addresses:
+            raise OSError("Name or service not known")
+        return self.addresses[host]
+
+
+ADDRESSES = {
+    "trojan.example.com": "203.0.113.1",
+    "vless.example.com": "203.0.113.2",
+    "hy.example.com": "2001:db8::3",
+}
+
+
+def test_resolver_looks_up_each_host_once(tmp_path):
+    resolve = FakeResolve(ADDRESSES)
+    cache = str(tmp_path / "resolve.json")
+    resolver = v2builder.AddressResolver(cache, resolve=resolve)
+
+    trojan, vless = SERVERS["trojan"], SERVERS["vless"]
+    pinned = resolver.pin([trojan, [trojan, vless], vless])
+    resolver.pin([trojan])
+    assert resolve.calls == {"trojan.example.com": 1, "vless.example.com": 1}
+    assert pinned[1][0]["addr"] == "203.0.113.1"
+    assert pinned[2]["addr"] == "203.0.113.2"
+
+    # The answers outlive the process until the ttl runs out
+    resolve = FakeResolve(ADDRESSES)
+    v2builder.AddressResolver(cache, resolve=resolve).pin([trojan])
+    assert resolve.calls == {}
+
+    # An answer stored with a ttl of 0 is expired on the next lookup
+    resolver = v2builder.AddressResolver(cache, ttl=0, resolve=resolve)
+    resolver.pin([SERVERS["hysteria2"]])
+    resolver.pin([SERVERS["hysteria2"]])
+    assert resolve.calls == {"hy.example.com": 2}
+
+
+def test_failed_lookup_keeps_the_hostname():
+    resolve = FakeResolve({})
+    resolver = v2builder.AddressResolver(resolve=resolve)
+
+    server = dict(SERVERS["trojan"], sni="")
+    assert resolver.pin([server]) == [server]
+    assert resolver.pin([server]) == [server]
+    assert resolve.calls == {"trojan.example.com": 2}
+
+
+def test_pinned_servers_keep_the_hostname_for_tls(template):
+    resolver = v2builder.AddressResolver(resolve=FakeResolve(ADDRESSES))
+    servers = [
+        dict(SERVERS["trojan"], sni=""),
+        dict(SERVERS["vless"], sni=[""], host=[]),
+        SERVERS["hysteria2"],
+        dict(SERVERS["vless-reality"], addr="vless.example.com"),
+    ]
+    trojan, vless, hysteria2, reality = resolver.pin(servers)
+
+    outbound = json.loads(template.render(trojan, 30000))["outbounds"][0]
+    assert outbound["settings"]["servers"][0]["address"] == "203.0.113.1"
+    assert outbound["streamSettings"]["tlsSettings"]["serverName"] == (
+        "trojan.example.com"
+    )
+
+    outbound = json.loads(template.render(vless, 30000))["outbounds"][0]
+    assert outbound["settings"]["vnext"][0]["address"] == "203.0.113.2"
+    assert outbound["streamSettings"]["tlsSettings"]["serverName"] == (
+        "vless.example.com"
+    )
+    assert outbound["streamSettings"]["wsSettings"]["headers"]["Host"] == (
+        "vless.example.com"
+    )
+
+    sidecar = v2builder.build_sidecar(v2builder.load_protocols(hysteria2))
+    assert sidecar["server"] == "[2001:db8::3]:8443"
+    assert sidecar["tls"]["sni"] == "hy.example.com"
+
+    # A given sni is the name the server expects, it is never replaced
+    assert reality["addr"] == "203.0.113.2"
+    assert reality["sni"] == ["www.apple.com"]
+
+
+@pytest.mark.parametrize(
+    "server, error",
+    [
+        (
+            dict(SERVERS["vless-reality"], sni=[]),
+            "outbound proxy realitySettings.serverName should be a non-empty string",
+        ),
+        (
+            dict(SERVERS["vless-reality"], pbk=[]),
+            "outbound proxy realitySettings.publicKey should be a non-empty string",
+        ),
+    ],
+    ids=["empty serverName", "no publicKey"],
+)
+def test_invalid_server_is_not_written(template, tmp_path, capsys, server, error):
+    files = write_servers(tmp_path, server)
+
+    out = build_invalid(
+        tmp_path, capsys, [{"country": "jp", "port": 30000, "file": files[0]}]
+    )
+    assert f"\033[1;31mconfig_jp.json\033[0m: {error}" in out
+
+
+def test_reality_without_short_id_is_invalid(template):
+    config = json.loads(template.render(SERVERS["vless-reality"], 30000))
+    assert v2builder.validate_config(config) == []
+
+    del config["outbounds"][0]["streamSettings"]["realitySettings"]["shortId"]
+    assert v2builder.validate_config(config) == [
+        "outbound proxy realitySettings.shortId should be a string"
+    ]
+
+
+def test_port_collision_across_clusters(template, tmp_path, capsys):
+    files = write_servers(tmp_path, SERVERS["vmess"], SERVERS["trojan"])
+
+    out = build_invalid(
+        tmp_path,
+        capsys,
+        [
+            {"country": "hk", "port": 30000, "file": files[0]},
+            {"country": "jp", "port": 30001, "file": files[1]},
+        ],
+    )
+    assert (
+        "\033[1;31mconfig_jp.json\033[0m: inbound http port 30001 is already used "
+        "by config_hk.json" in out
+    )
+
+
+@pytest.mark.parametrize(
+    "rule, error",
+    [
+        ({"outboundTag": "nowhere"}, "routes to unknown outbound nowhere"),
+        ({"balancerTag": "nowhere"}, "routes to unknown balancer nowhere"),
+    ],
+    ids=["outbound", "balancer"],
+)
+def test_unknown_routing_tag(template, tmp_path, capsys, monkeypatch, rule, error):
+    routing = v2builder.load_routing()
+    rules = routing.rule_dicts() + [dict(type="field", domain=["x.com"], **rule)]
+    monkeypatch.setattr(
+        v2builder,
+        "load_routing",
+        lambda cache_path=None: v2builder.CompiledRouting.create(
+            routing.domain_strategy, rules
+        ),
+    )
+    files = write_servers(tmp_path, SERVERS["vmess"])
+
+    out = build_invalid(
+        tmp_path, capsys, [{"country": "hk", "port": 30000, "file": files[0]}]
+    )
+    assert f"\033[1;31mconfig_hk.json\033[0m: rule {len(rules) - 1} {error}" in out
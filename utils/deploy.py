@@ -0,0 +1,684 @@
+#!/usr/bin/env python3
+# Author: Dot(anty2bot)
+# Date: 2026-10-18
+# Description: This is a Python script used to deploy the proxy containers of
+#              every cluster through the Docker Engine API, the standard library
+#              only so it runs on the remote host as it is
+#
+# Usage:
+# 1). recreate the containers whose config or image changed, 4 at a time
+# $ python3 deploy.py clusters.json --status on --configs /tmp -j 4
+#
+# 2). stop and remove every container of the manifest
+# $ python3 deploy.py clusters.json --status off
+#
+# 3). against another Docker API, e.g. a fake one listening on TCP
+# $ python3 deploy.py clusters.json --docker http://127.0.0.1:2375
+#
+# 4). an unpacked v2builder.py --bundle, the configs sit next to the manifest
+# $ python3 bundle/deploy.py bundle/manifest.json
+
+import os
+import json
+import time
+import shutil
+import socket
+import hashlib
+import threading
+import http.client
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+
+DOCKER_SOCKET = "unix:///var/run/docker.sock"
+
+# Image, image ID, config path in the container and command of each client,
+# the image and ID are overridden by the sha256 files
+CLIENTS = {
+    "v2fly": {
+        "image": "v2fly/v2fly-core:v5.16.1",
+        "image_id": "sha256:d1c717b3cc8c7602fdb89a886d0c7fc0cf8c1d973501101d5f5e86f1ec6dcccf",
+        "config": "/etc/v2fly/config.json",
+        "cmd": ["run", "-c", "/etc/v2fly/config.json"],
+    },
+    "xray": {
+        "image": "teddysun/xray:25.7.26",
+        "image_id": "sha256:5ca9e4c01ed0d42437d709403b531f14fac10cb84fcd49e5307b9f72eb09a8ea",
+        "config": "/etc/xray/config.json",
+        "cmd": None,
+    },
+}
+
+# hysteria2 client sidecar, it only runs once hysteria.sha256 pins its ID
+SIDECAR_NAME = "hysteria"
+SIDECAR = {
+    "image": "tobyxdd/hysteria:v2.6.2",
+    "image_id": None,
+    "config": "/etc/hysteria/config.json",
+    "cmd": ["client", "-c", "/etc/hysteria/config.json"],
+}
+SIDECAR_SUFFIX = ".hysteria2.json"
+
+CONFIG_LABEL = "config.sha256"
+PULL_ATTEMPTS = 5
+
+
+class DockerError(Exception):
+    def __init__(self, message, status=None) -> None:
+        super().__init__(message if status is None else f"{status}: {message}")
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout) -> None:
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DockerClient:
+    """
+    The few Docker Engine API calls the deployment needs, a connection per
+    request so the deploy threads share nothing
+    """
+
+    def __init__(self, url=DOCKER_SOCKET, timeout=60) -> None:
+        self.url = urllib.parse.urlsplit(url)
+        self.timeout = timeout
+
+    def connect(self):
+        if self.url.scheme == "unix":
+            return UnixHTTPConnection(self.url.path, self.timeout)
+        return http.client.HTTPConnection(self.url.netloc, timeout=self.timeout)
+
+    def request(
+        self, method, path, query=None, body=None, headers=None, ok=(), stream=False
+    ):
+        """
+        Returns (status, body), JSON bodies are decoded and statuses in ok
+        are not errors. Streamed endpoints (pull, load) answer one JSON
+        object per line, stream returns the list of them
+        """
+        if query:
+            path = f"{path}?{urllib.parse.urlencode(query)}"
+        headers = dict(headers or {})
+        if isinstance(body, dict):
+            body = json.dumps(body).encode("utf-8")
+            headers["Content-Type"] = "application/json"
+
+        conn = self.connect()
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+            data = response.read()
+        finally:
+            conn.close()
+
+        if response.status >= 400 and response.status not in ok:
+            try:
+                message = json.loads(data)["message"]
+            except (ValueError, KeyError, TypeError):
+                message = data.decode("utf-8", "replace").strip()
+            raise DockerError(message, response.status)
+
+        if "json" not in response.getheader("Content-Type", ""):
+            return response.status, data
+        if not stream:
+            return response.status, json.loads(data) if data.strip() else None
+
+        messages = [json.loads(line) for line in data.splitlines() if line.strip()]
+        for message in messages:
+            if isinstance(message, dict) and message.get("error"):
+                raise DockerError(message["error"], response.status)
+        return response.status, messages
+
+    def inspect_image(self, name):
+        status, image = self.request("GET", f"/images/{name}/json", ok=(404,))
+        return None if status == 404 else image
+
+    def load_image(self, path):
+        with open(path, "rb") as f:
+            self.request(
+                "POST",
+                "/images/load",
+                {"quiet": "1"},
+                body=f,
+                headers={
+                    "Content-Type": "application/x-tar",
+                    "Content-Length": str(os.path.getsize(path)),
+                },
+                stream=True,
+            )
+
+    def pull_image(self, name):
+        repository, tag = name, "latest"
+        if ":" in name.rsplit("/", 1)[-1]:
+            repository, tag = name.rsplit(":", 1)
+        self.request(
+            "POST",
+            "/images/create",
+            {"fromImage": repository, "tag": tag},
+            stream=True,
+        )
+
+    def inspect_container(self, name):
+        status, container = self.request("GET", f"/containers/{name}/json", ok=(404,))
+        return None if status == 404 else container
+
+    def create_container(self, name, spec):
+        _, container = self.request(
+            "POST", "/containers/create", {"name": name}, body=spec
+        )
+        return container["Id"]
+
+    def start_container(self, name):
+        self.request("POST", f"/containers/{name}/start")
+
+    def remove_container(self, name, timeout=10):
+        """
+        Stop then remove, False if there was no such container
+        """
+        status, _ = self.request(
+            "POST", f"/containers/{name}/stop", {"t": timeout}, ok=(404,)
+        )
+        if status == 404:
+            return False
+        self.request("DELETE", f"/containers/{name}", {"force": "1"}, ok=(404,))
+        return True
+
+
+def file_sha256(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_clients(sha256_dir):
+    """
+    CLIENTS and the SIDECAR_NAME sidecar, with the image and image ID of
+    <name>.sha256 when it exists
+    """
+    clients = {}
+    for name, client in [*CLIENTS.items(), (SIDECAR_NAME, SIDECAR)]:
+        client = dict(client)
+        path = os.path.join(sha256_dir, f"{name}.sha256")
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                fields = f.read().split()
+            if fields:
+                client["image"] = fields[0]
+                client["image_id"] = fields[1] if len(fields) > 1 else None
+        clients[name] = client
+
+    return clients
+
+
+def load_manifest(path):
+    with open(path, "r") as f:
+        manifest = json.load(f)
+
+    for cluster in manifest["clusters"]:
+        assert cluster["client"] in CLIENTS, f"Unsupported client: {cluster['client']}"
+        assert isinstance(cluster["port"], int), f"Invalid port: {cluster['port']}"
+        assert cluster["country"], "country is required"
+
+    return manifest
+
+
+def has_sidecar(cluster, configs):
+    name = f"config_{cluster['country']}{SIDECAR_SUFFIX}"
+    return bool(cluster.get("sidecar_sha256")) or os.path.isfile(
+        os.path.join(configs, name)
+    )
+
+
+def verify_configs(manifest, configs):
+    """
+    Errors of the configs whose sha256 differs from the one in the manifest,
+    only v2builder.py --bundle manifests carry them
+    """
+    errors = []
+    for cluster in manifest["clusters"]:
+        name = f"config_{cluster['country']}.json"
+        files = [(name, cluster.get("sha256"))]
+        if cluster.get("sidecar_sha256"):
+            files.append(
+                (name[: -len(".json")] + SIDECAR_SUFFIX, cluster["sidecar_sha256"])
+            )
+
+        for name, expected in files:
+            path = os.path.join(configs, name)
+            if expected is None:
+                continue
+            if not os.path.isfile(path):
+                errors.append(f"{name}: missing")
+            elif file_sha256(path) != expected:
+                errors.append(f"{name}: sha256 does not match the manifest")
+
+    return errors
+
+
+class Deployer:
+    """
+    Recreates the containers of the manifest on a thread pool. A container
+    is kept when it runs the same image and config, a recreated one has to
+    pass the health gate, and once more than max_failures recreations failed
+    the clusters not started yet are left untouched. A cluster whose image
+    could not be set up fails alone, the others are still deployed
+    """
+
+    def __init__(
+        self,
+        docker,
+        clients,
+        configs="/tmp",
+        config_dir="/etc",
+        images="/tmp",
+        health_timeout=30.0,
+        settle=2.0,
+        max_failures=0,
+    ) -> None:
+        self.docker = docker
+        self.clients = clients
+        self.configs = configs
+        self.config_dir = config_dir
+        self.images = images
+        self.health_timeout = health_timeout
+        self.settle = settle
+        self.max_failures = max_failures
+
+        self.failures = 0
+        self.unavailable = {}
+        self.lock = threading.Lock()
+
+    def log(self, name, message):
+        with self.lock:
+            print(f"{name}: {message}", flush=True)
+
+    def setup_image(self, name):
+        """
+        Load the image from <images>/<name>.tar or pull it, then check the
+        pinned image ID
+        """
+        image = self.clients[name]["image"]
+        if not self.clients[name]["image_id"]:
+            raise DockerError(f"{name}.sha256 pins no image ID for {image}")
+
+        tar = os.path.join(self.images, f"{name}.tar")
+        if self.docker.inspect_image(image) is None and os.path.isfile(tar):
+            self.docker.load_image(tar)
+
+        for i in range(1, PULL_ATTEMPTS + 1):
+            if self.docker.inspect_image(image) is not None:
+                break
+            print(f"{image} is not downloaded. Trying to pull the image...")
+            try:
+                self.docker.pull_image(image)
+            except DockerError as e:
+                print(f"Download failed ({e}). Retrying in 3 seconds... ({i}/5)")
+                time.sleep(3)
+
+        found = self.docker.inspect_image(image)
+        if found is None or found["Id"] != self.clients[name]["image_id"]:
+            raise DockerError(f"{image} is not valid")
+
+    def required_images(self, cluster):
+        names = [cluster["client"]]
+        if has_sidecar(cluster, self.configs):
+            names.append(SIDECAR_NAME)
+        return names
+
+    def setup_images(self, clusters):
+        """
+        setup_image every image the clusters need, the error of an image
+        that fails is kept in unavailable
+        """
+        names = set()
+        for cluster in clusters:
+            names.update(self.required_images(cluster))
+
+        for name in sorted(names):
+            try:
+                self.setup_image(name)
+            except DockerError as e:
+                print(f"\033[1;31m{e}\033[0m")
+                self.unavailable[name] = str(e)
+
+    def host_config(self, kind, country):
+        """
+        Per cluster path of the config on the host, bound to the container
+        """
+        name = os.path.basename(os.path.dirname(kind["config"]))
+        return os.path.join(self.config_dir, name, f"config_{country}.json")
+
+    def install(self, source, target):
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(source, target)
+
+    def health_gate(self, name):
+        """
+        Wait for the healthcheck when the image has one, otherwise for the
+        container to keep running for settle seconds
+        """
+        deadline = time.monotonic() + self.health_timeout
+        running_since = None
+
+        while time.monotonic() < deadline:
+            state = self.docker.inspect_container(name)["State"]
+            if state["Status"] in ("exited", "dead"):
+                error = (
+                    state.get("Error") or f"exited with code {state.get('ExitCode')}"
+                )
+                raise DockerError(error)
+
+            health = (state.get("Health") or {}).get("Status")
+            if health == "healthy":
+                return
+            if health == "unhealthy":
+                raise DockerError("unhealthy")
+
+            if state["Running"] and not state.get("Restarting"):
+                running_since = running_since or time.monotonic()
+                if health is None and time.monotonic() - running_since >= self.settle:
+                    return
+            else:
+                running_since = None
+            time.sleep(0.2)
+
+        raise DockerError(f"not ready after {self.health_timeout} seconds")
+
+    def deploy_proxy(self, cluster):
+        """
+        Returns "unchanged" or "recreated"
+        """
+        client = self.clients[cluster["client"]]
+        name = f"proxy-{cluster['country']}"
+        source = os.path.join(self.configs, f"config_{cluster['country']}.json")
+        sha256 = cluster.get("sha256") or file_sha256(source)
+
+        container = self.docker.inspect_container(name)
+        if (
+            container is not None
+            and container["State"]["Running"]
+            and container["Image"] == client["image_id"]
+            and (container["Config"]["Labels"] or {}).get(CONFIG_LABEL) == sha256
+        ):
+            os.remove(source)
+            return "unchanged"
+
+        self.docker.remove_container(name)
+
+        target = self.host_config(client, cluster["country"])
+        self.install(source, target)
+
+        ports = (cluster["port"], cluster["port"] + 1)
+        spec = {
+            "Image": client["image"],
+            "Labels": {CONFIG_LABEL: sha256},
+            "ExposedPorts": {f"{port}/tcp": {} for port in ports},
+            "HostConfig": {
+                "Binds": [f"{target}:{client['config']}"],
+                "PortBindings": {
+                    f"{port}/tcp": [{"HostPort": str(port)}] for port in ports
+                },
+            },
+        }
+        if client["cmd"]:
+            spec["Cmd"] = client["cmd"]
+
+        self.docker.create_container(name, spec)
+        self.docker.start_container(name)
+        self.health_gate(name)
+        return "recreated"
+
+    def deploy_sidecar(self, cluster):
+        """
+        The hysteria2 sidecar lives in the network namespace of the proxy
+        container, it is recreated with it. Returns None without a sidecar
+        """
+        owner = f"proxy-{cluster['country']}"
+        name = f"{owner}-hysteria2"
+        source = os.path.join(
+            self.configs, f"config_{cluster['country']}{SIDECAR_SUFFIX}"
+        )
+
+        if not os.path.isfile(source):
+            if self.docker.remove_container(name):
+                return "removed"
+            return None
+
+        sidecar = self.clients[SIDECAR_NAME]
+        sha256 = cluster.get("sidecar_sha256") or file_sha256(source)
+        network = f"container:{self.docker.inspect_container(owner)['Id']}"
+
+        container = self.docker.inspect_container(name)
+        if (
+            container is not None
+            and container["State"]["Running"]
+            and container["Image"] == sidecar["image_id"]
+            and container["HostConfig"]["NetworkMode"] == network
+            and (container["Config"]["Labels"] or {}).get(CONFIG_LABEL) == sha256
+        ):
+            os.remove(source)
+            return "unchanged"
+
+        self.docker.remove_container(name)
+
+        target = self.host_config(sidecar, cluster["country"])
+        self.install(source, target)
+
+        self.docker.create_container(
+            name,
+            {
+                "Image": sidecar["image"],
+                "Cmd": sidecar["cmd"],
+                "Labels": {CONFIG_LABEL: sha256},
+                "HostConfig": {
+                    "Binds": [f"{target}:{sidecar['config']}"],
+                    "NetworkMode": network,
+                },
+            },
+        )
+        self.docker.start_container(name)
+        self.health_gate(name)
+        return "recreated"
+
+    def deploy(self, cluster):
+        """
+        Returns the status of the cluster: unchanged, recreated, skipped or
+        failed
+        """
+        name = f"proxy-{cluster['country']}"
+
+        # The containers are left as they are, this is not a failed rollout
+        for image in self.required_images(cluster):
+            if image in self.unavailable:
+                self.log(name, f"\033[1;31mfailed\033[0m {self.unavailable[image]}")
+                return "failed"
+
+        with self.lock:
+            skipped = self.failures > self.max_failures
+        if skipped:
+            self.log(name, "skipped")
+            return "skipped"
+
+        try:
+            status = self.deploy_proxy(cluster)
+            self.log(name, status)
+            sidecar = self.deploy_sidecar(cluster)
+            if sidecar is not None:
+                self.log(f"{name}-hysteria2", sidecar)
+                if sidecar != "unchanged":
+                    status = "recreated"
+        except (DockerError, OSError) as e:
+            with self.lock:
+                self.failures += 1
+            self.log(name, f"\033[1;31mfailed\033[0m {e}")
+            return "failed"
+
+        return status
+
+    def turn_off(self, cluster):
+        name = f"proxy-{cluster['country']}"
+        try:
+            self.docker.remove_container(f"{name}-hysteria2")
+            removed = self.docker.remove_container(name)
+        except DockerError as e:
+            self.log(name, f"\033[1;31mfailed\033[0m {e}")
+            return "failed"
+
+        for kind in (self.clients[cluster["client"]], SIDECAR):
+            path = self.host_config(kind, cluster["country"])
+            if os.path.isfile(path):
+                os.remove(path)
+
+        self.log(name, "turn off")
+        return "removed" if removed else "unchanged"
+
+
+def args_parse():
+    example_commands = (
+        "Examples:\n\n"
+        "  # Deploy the clusters of (\033[1;34mMANIFEST\033[0m) with the configs in /tmp\n"
+        "  \033[1;32m$ python3 deploy.py clusters.json --status on --configs /tmp\033[0m\n"
+        "\n"
+        "  # Deploy an unpacked v2builder.py --bundle\n"
+        "  \033[1;32m$ python3 bundle/deploy.py bundle/manifest.json\033[0m\n"
+        "\n"
+        "  # Stop and remove every container of (\033[1;34mMANIFEST\033[0m)\n"
+        "  \033[1;32m$ python3 deploy.py clusters.json --status off\033[0m\n"
+        "\n"
+    )
+
+    parser = ArgumentParser(
+        description="proxy containers deploy agent",
+        epilog=example_commands,
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument(
+        "manifest",
+        metavar="MANIFEST",
+        help='JSON file, {"clusters": [{"client", "country", "port"}, ...]}',
+    )
+
+    parser.add_argument(
+        "--status",
+        choices=["on", "off"],
+        default="on",
+        help="Deploy the clusters, or stop and remove their containers",
+    )
+
+    files = parser.add_argument_group("files Options")
+    files.add_argument(
+        "--configs",
+        metavar="DIR",
+        required=False,
+        help="Directory with the config_<country>.json files of v2builder.py, by "
+        "default the directory of MANIFEST",
+    )
+    files.add_argument(
+        "--config_dir",
+        metavar="DIR",
+        default="/etc",
+        help="The configs are kept at DIR/<client>/config_<country>.json",
+    )
+    files.add_argument(
+        "--sha256",
+        metavar="DIR",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "sha256"),
+        help="Directory with the <client>.sha256 image pins",
+    )
+    files.add_argument(
+        "--images",
+        metavar="DIR",
+        default="/tmp",
+        help="Directory with the <client>.tar images to load before pulling",
+    )
+
+    deploy = parser.add_argument_group("deploy Options")
+    deploy.add_argument(
+        "--docker",
+        metavar="URL",
+        default=os.environ.get("DOCKER_HOST", DOCKER_SOCKET),
+        help="Docker Engine API, unix:///path or http://host:port",
+    )
+    deploy.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        default=4,
+        type=int,
+        help="Number of containers recreated at once",
+    )
+    deploy.add_argument(
+        "--health_timeout",
+        metavar="SECONDS",
+        default=30.0,
+        type=float,
+        help="Time a recreated container has to become ready",
+    )
+    deploy.add_argument(
+        "--settle",
+        metavar="SECONDS",
+        default=2.0,
+        type=float,
+        help="Time a container without healthcheck has to keep running",
+    )
+    deploy.add_argument(
+        "--max_failures",
+        metavar="N",
+        default=0,
+        type=int,
+        help="Failed recreations tolerated before the rest of the rollout stops",
+    )
+
+    return parser.parse_args()
+
+
+def main():
+    args = args_parse()
+
+    manifest = load_manifest(args.manifest)
+    configs = args.configs or os.path.dirname(os.path.abspath(args.manifest))
+    deployer = Deployer(
+        DockerClient(args.docker),
+        load_clients(args.sha256),
+        configs,
+        args.config_dir,
+        args.images,
+        args.health_timeout,
+        args.settle,
+        args.max_failures,
+    )
+
+    if args.status == "on":
+        # A damaged bundle is rejected before any container is touched
+        errors = verify_configs(manifest, configs)
+        for error in errors:
+            print(f"\033[1;31m{error}\033[0m")
+        if errors:
+            exit(1)
+
+        deployer.setup_images(manifest["clusters"])
+        work = deployer.deploy
+    else:
+        work = deployer.turn_off
+
+    with ThreadPoolExecutor(max_workers=max(1, args.jobs)) as executor:
+        results = list(executor.map(work, manifest["clusters"]))
+
+    changed = sum(result in ("recreated", "removed") for result in results)
+    print(
+        f"Deployed \033[1;32m{len(results)}\033[0m clusters, changed: {changed}, "
+        f"failed: {results.count('failed')}, skipped: {results.count('skipped')}"
+    )
+    if "failed" in results:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# Author: Dot(anty2bot)
+# Date: 2026-10-18
+# Description: This is a Python module for per-stage timing and counters of the CLIs
+#
+# Usage:
+#   from metrics import STATS
+#
+#   with STATS.stage("fetch") as stage:
+#       data = subscribe(url)
+#       stage.add(nbytes=len(data), items=1)
+#
+#   STATS.dump("-")
+
+import sys
+import json
+import time
+import cProfile
+import threading
+import contextlib
+
+
+class Stage:
+    __slots__ = ("seconds", "calls", "items", "bytes")
+
+    def __init__(self) -> None:
+        self.seconds = 0.0
+        self.calls = 0
+        self.items = 0
+        self.bytes = 0
+
+    def add(self, seconds=0.0, items=0, nbytes=0, calls=0):
+        self.seconds += seconds
+        self.calls += calls
+        self.items += items
+        self.bytes += nbytes
+
+
+class Stats:
+    """
+    Wall time, calls, items and bytes per named stage, safe to update from
+    the fetch threads
+    """
+
+    def __init__(self) -> None:
+        self.stages = {}
+        self.lock = threading.Lock()
+        self.started = time.perf_counter()
+
+    def get(self, name) -> Stage:
+        with self.lock:
+            return self.stages.setdefault(name, Stage())
+
+    def add(self, name, seconds=0.0, items=0, nbytes=0, calls=1):
+        stage = self.get(name)
+        with self.lock:
+            stage.add(seconds, items, nbytes, calls)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        counter = Stage()
+        start = time.perf_counter()
+        try:
+            yield counter
+        finally:
+            seconds = time.perf_counter() - start
+            self.add(name, seconds, counter.items, counter.bytes)
+
+    def to_dict(self):
+        with self.lock:
+            stages = {
+                name: {
+                    "seconds": round(stage.seconds, 6),
+                    "calls": stage.calls,
+                    "items": stage.items,
+                    "bytes": stage.bytes,
+                }
+                for name, stage in self.stages.items()
+            }
+
+        return {
+            "total_seconds": round(time.perf_counter() - self.started, 6),
+            "stages": stages,
+        }
+
+    def dump(self, path):
+        """
+        Write the stats as JSON to path, "-" is stderr, stdout carries the
+        progress prints
+        """
+        if path == "-":
+            json.dump(self.to_dict(), sys.stderr, indent=4)
+            sys.stderr.write("\n")
+            return
+
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+
+STATS = Stats()
+
+
+@contextlib.contextmanager
+def profiled(path=None):
+    """
+    Run the block under cProfile and save the pstats to path, a no-op
+    without a path
+    """
+    if not path:
+        yield
+        return
+
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# Author: Dot(anty2bot)
+# Date: 2026-10-18
+# Description: This is a Python script used to probe the latency of decoded servers
+#
+# Usage:
+# 1). probe every server of the sub2json.py catalog, write ~/.cache/ranking.json
+# $ python3 prober.py -c ~/.cache
+#
+# 2). more parallel probes, 5 attempts each
+# $ python3 prober.py -c ~/.cache --parallel 128 --attempts 5
+
+import os
+import ssl
+import json
+import socket
+import time
+import asyncio
+import statistics
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from v2builder import first, ServerProtocolC, ServerProtocolD, ServerProtocolE
+
+# Written by sub2json.py, read back by v2builder.py
+CATALOG_INDEX_FILE = "servers.index.json"
+RANKING_FILE = "ranking.json"
+
+# QUIC based protocols, a TCP probe tells nothing about them
+UDP_PROTOCOLS = (ServerProtocolD.NAME,)
+
+
+def tls_server_name(server):
+    """
+    SNI of the TLS handshake, None if the server does not speak TLS
+    """
+    protocol = server.get("protocol")
+
+    if protocol == ServerProtocolC.NAME:
+        return first(server.get("sni")) or server.get("addr")
+
+    if protocol == ServerProtocolE.NAME:
+        if first(server.get("security")) in ("tls", "reality"):
+            return first(server.get("sni")) or server.get("addr")
+
+    return None
+
+
+def create_ssl_context():
+    # Handshake timing only, reality and allowInsecure servers fail verification
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def probe_once(host, port, server_name, timeout, ssl_context):
+    """
+    Returns (tcp_ms, tls_ms), tls_ms is None without a server_name
+    """
+    start = time.perf_counter()
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host, port), timeout
+    )
+    tcp_ms = (time.perf_counter() - start) * 1000
+    tls_ms = None
+
+    try:
+        if server_name is not None:
+            start = time.perf_counter()
+            await asyncio.wait_for(
+                writer.start_tls(ssl_context, server_hostname=server_name), timeout
+            )
+            tls_ms = (time.perf_counter() - start) * 1000
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+
+    return tcp_ms, tls_ms
+
+
+async def probe_server(server, attempts=3, timeout=3.0, ssl_context=None):
+    result = {
+        "id": server.get("id"),
+        "file": server.get("file"),
+        "protocol": server.get("protocol"),
+        "addr": server.get("addr"),
+        "port": int(server.get("port")),
+        "note": server.get("note"),
+        "tcp_ms": None,
+        "tls_ms": None,
+        "loss": 1.0,
+    }
+
+    if server.get("protocol") in UDP_PROTOCOLS:
+        result["loss"] = None
+        result["error"] = "udp"
+        return result
+
+    loop = asyncio.get_running_loop()
+    try:
+        # Resolve once, the connect time should not include the DNS lookup
+        infos = await asyncio.wait_for(
+            loop.getaddrinfo(result["addr"], result["port"], type=socket.SOCK_STREAM),
+            timeout,
+        )
+        host = infos[0][4][0]
+    except (OSError, asyncio.TimeoutError) as e:
+        result["error"] = f"resolve: {e}"
+        return result
+
+    server_name = tls_server_name(server)
+    ssl_context = create_ssl_context() if ssl_context is None else ssl_context
+
+    tcp, tls, errors = [], [], []
+    for _ in range(attempts):
+        try:
+            tcp_ms, tls_ms = await probe_once(
+                host, result["port"], server_name, timeout, ssl_context
+            )
+        except (OSError, ssl.SSLError, asyncio.TimeoutError) as e:
+            errors.append(type(e).__name__)
+            continue
+
+        tcp.append(tcp_ms)
+        if tls_ms is not None:
+            tls.append(tls_ms)
+
+    result["loss"] = round(1 - len(tcp) / attempts, 3)
+    if tcp:
+        result["tcp_ms"] = round(statistics.median(tcp), 2)
+    if tls:
+        result["tls_ms"] = round(statistics.median(tls), 2)
+    if errors:
+        result["error"] = errors[-1]
+
+    return result
+
+
+async def probe_all(servers, parallel=64, attempts=3, timeout=3.0, ssl_context=None):
+    semaphore = asyncio.Semaphore(parallel)
+
+    async def bounded(server):
+        async with semaphore:
+            return await probe_server(server, attempts, timeout, ssl_context)
+
+    return await asyncio.gather(*(bounded(server) for server in servers))
+
+
+def rank(results):
+    """
+    Reachable servers first, by loss and then by connect plus handshake time
+    """
+
+    def score(result):
+        if result["tcp_ms"] is None:
+            return (1, float("inf"))
+        return (result["loss"], result["tcp_ms"] + (result["tls_ms"] or 0))
+
+    return sorted(results, key=score)
+
+
+def load_catalog(path):
+    path = os.path.expanduser(path)
+    with open(os.path.join(path, CATALOG_INDEX_FILE), "r", encoding="utf-8") as f:
+        index = json.load(f)
+
+    files = {sid: name for name, sid in index["file"].items()}
+
+    servers = []
+    with open(os.path.join(path, index["catalog"]), "rb") as f:
+        for sid, (offset, length) in index["id"].items():
+            f.seek(offset)
+            server = json.loads(f.read(length).decode("utf-8"))
+            server.update({"id": sid, "file": files.get(sid)})
+            servers.append(server)
+
+    return servers
+
+
+def write_ranking(path, results):
+    ranking = {
+        "probed_at": int(time.time()),
+        "servers": rank(results),
+    }
+
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(ranking, f, indent=4, ensure_ascii=False)
+
+
+def args_parse():
+    example_commands = (
+        "Examples:\n\n"
+        "  # Probe the catalog in (\033[1;34mDIR\033[0m), ranking is saved to DIR/ranking.json\n"
+        "  \033[1;32m$ python3 prober.py -c ~/.cache\033[0m\n"
+        "\n"
+    )
+
+    parser = ArgumentParser(
+        description="server latency prober",
+        epilog=example_commands,
+        formatter_class=RawDescriptionHelpFormatter,
+    )
+
+    parser.add_argument(
+        "-c",
+        "--catalog",
+        metavar="DIR",
+        required=True,
+        help="Directory with the servers.jsonl catalog of sub2json.py",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        metavar="FILE",
+        required=False,
+        help="Path to the ranking file, by default DIR/ranking.json",
+    )
+
+    probe = parser.add_argument_group("probe Options")
+    probe.add_argument(
+        "--parallel",
+        metavar="N",
+        default=64,
+        type=int,
+        help="Number of servers probed at once",
+    )
+    probe.add_argument(
+        "--attempts",
+        metavar="N",
+        default=3,
+        type=int,
+        help="Connections per server, failed ones count as loss",
+    )
+    probe.add_argument(
+        "--timeout",
+        metavar="SECONDS",
+        default=3.0,
+        type=float,
+        help="Timeout of each connect and handshake",
+    )
+
+    args = parser.parse_args()
+
+    if args.parallel < 1:
+        parser.error("--parallel must be a positive integer.")
+
+    if args.attempts < 1:
+        parser.error("--attempts must be a positive integer.")
+
+    return args
+
+
+def main():
+    args = args_parse()
+    output = args.output or os.path.join(os.path.expanduser(args.catalog), RANKING_FILE)
+
+    servers = load_catalog(args.catalog)
+    print(f"Probing \033[1;32m{len(servers)}\033[0m servers")
+
+    results = asyncio.run(
+        probe_all(servers, args.parallel, args.attempts, args.timeout)
+    )
+    write_ranking(output, results)
+
+    for result in rank(results)[:10]:
+        print(
+            f"{result['file']}: tcp {result['tcp_ms']} ms, tls {result['tls_ms']} ms, "
+            f"loss {result['loss']} ({result['note']})"
+        )
+    print(f"Ranking saved at \033[1;32m{os.path.realpath(output)}\033[0m")
+
+
+if __name__ == "__main__":
+    main()
@@ -9,15 +9,67 @@
 #
 # 2). subscribe FILE
 # $ python3 sub2json.py -r subscribe.data -o ./
+#
+# 3). every subscribe entry of the ansible config, fetched concurrently
+# $ python3 sub2json.py -c ~/.config/multi-client-config.yml
 
 import re
 import os
+import ast
 import urllib
 import json
+import codecs
 import base64
+import hashlib
+import time
+import binascii
+import tempfile
 import requests
+from metrics import STATS, profiled
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 
+# Patterns are compiled once at import, links are decoded in the hot loop
+EMOJI_PATTERN = re.compile(
+    "["
+    "\U0001f600-\U0001f64f"
+    "\U0001f300-\U0001f5ff"
+    "\U0001f680-\U0001f6ff"
+    "\U0001f1e0-\U0001f1ff"
+    "]+",
+    flags=re.UNICODE,
+)
+SURROGATE_PATTERN = re.compile(r"\\ud[0-9a-fA-F]{4}")
+USERINFO_PATTERN = re.compile(r"[:@]")
+URI_PATTERN = re.compile(r"[@:?#]")
+B64_NOISE_PATTERN = re.compile(rb"[^A-Za-z0-9+/=]")
+TRAILING_COMMA_PATTERN = re.compile(r",\s*([}\]])")
+
+# strict=False accepts raw control characters inside strings (e.g. "ps")
+JSON_DECODER = json.JSONDecoder(strict=False)
+
+# Base64 characters decoded per step, must be a multiple of 4
+B64_CHUNK_SIZE = 64 * 1024
+
+# Response metadata of the last fetch, kept next to subscribe.data
+FETCH_CACHE_FILE = "subscribe.cache.json"
+
+# Maps stable server IDs to the serverNN.json they are written to
+MANIFEST_FILE = "servers.manifest.json"
+SERVER_FILE_PATTERN = re.compile(r"server(\d+)\.json")
+
+# One compact record per line, plus its offset and secondary indexes
+CATALOG_FILE = "servers.jsonl"
+CATALOG_INDEX_FILE = "servers.index.json"
+
+# Pretend to access the subscription using a browser
+HEADERS = {
+    "User-Agent": (
+        "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+        "Chrome/114.0.0.0 Safari/537.36"
+    )
+}
+
 
 def base64_decode(data):
     return base64.urlsafe_b64decode(data + "=" * (4 - len(data) % 4)).decode("utf-8")
@@ -31,24 +83,117 @@ def good_content(s):
         return False
 
 
-def subscribe(url) -> bytes:
-    # Pretend to access the subscription using a browser
-    headers = {
-        "User-Agent": (
-            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
-            "Chrome/114.0.0.0 Safari/537.36"
-        )
-    }
+def create_session(jobs=4):
+    """
+    One pooled session shared by all fetches, connections to the same
+    provider host are kept alive and reused
+    """
+    adapter = requests.adapters.HTTPAdapter(pool_connections=jobs, pool_maxsize=jobs)
+
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+class FetchCache:
+    """
+    ETag, Last-Modified and SHA-256 of the last converted subscription body
+    """
+
+    def __init__(self, outdir) -> None:
+        self.path = os.path.join(outdir, FETCH_CACHE_FILE)
+        self.url = None
+        self.etag = None
+        self.last_modified = None
+        self.sha256 = None
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return
+
+        self.url = cached.get("url")
+        self.etag = cached.get("etag")
+        self.last_modified = cached.get("last_modified")
+        self.sha256 = cached.get("sha256")
+
+    def clear(self):
+        self.etag = self.last_modified = self.sha256 = None
+
+    def headers(self, url):
+        if url != self.url:
+            return {}
+
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        return headers
+
+    def update(self, url, response):
+        self.url = url
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+
+    def unchanged(self, data):
+        return self.sha256 == hashlib.sha256(data).hexdigest()
+
+    def commit(self, data):
+        """
+        Only called once the body was converted, a failed run is retried
+        """
+        self.sha256 = hashlib.sha256(data).hexdigest()
+        self.save()
+
+    def save(self):
+        """
+        Persist the validators, also when the body is the same one already
+        converted, or the next request would send a stale ETag
+        """
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "url": self.url,
+                    "etag": self.etag,
+                    "last_modified": self.last_modified,
+                    "sha256": self.sha256,
+                },
+                f,
+                indent=4,
+            )
+
+
+def subscribe(url, session=None, timeout=(10, 10), cache=None) -> bytes:
+    """
+    Returns None if a cache is given and the provider answers 304
+    """
+    headers = {} if cache is None else cache.headers(url)
 
     try:
-        response = requests.get(url=url, headers=headers, timeout=(10, 10))
+        if session is None:
+            response = requests.get(
+                url=url, headers={**HEADERS, **headers}, timeout=timeout
+            )
+        else:
+            response = session.get(url=url, headers=headers, timeout=timeout)
 
     except Exception:
         raise ValueError("requests.get() Exception")
 
+    if cache is not None and response.status_code == 304:
+        return None
+
     if response.content == b"" or not good_content(response.content):
-        print("\033[1;31mPlease check if your subscription link is valid\033[0m")
-        exit(1)
+        raise ValueError("Please check if your subscription link is valid")
+
+    if cache is not None:
+        cache.update(url, response)
 
     return response.content
 
@@ -68,15 +213,7 @@ class ProtocolA:
     PROTOCOL = b"\x73\x68\x61\x64\x6f\x77\x73\x6f\x63\x6b\x73".decode()
 
     def _remove_code(self, text):
-        return re.compile(
-            "["
-            "\U0001F600-\U0001F64F"
-            "\U0001F300-\U0001F5FF"
-            "\U0001F680-\U0001F6FF"
-            "\U0001F1E0-\U0001F1FF"
-            "]+",
-            flags=re.UNICODE,
-        ).sub(r"", text)
+        return EMOJI_PATTERN.sub(r"", text)
 
     def decode(self, link):
         body = link.replace(self.NAME, "").replace("\r", "")
@@ -95,7 +232,7 @@ class ProtocolA:
               [method]:[uuid]@[addr]:[port]
 
             """
-            method, uuid, addr, port = re.split(r"[:@]", base64_decode(header))
+            method, uuid, addr, port = USERINFO_PATTERN.split(base64_decode(header))
             note = footer
         except:
             """
@@ -109,7 +246,7 @@ class ProtocolA:
               [method]:[uuid]
 
             """
-            method_uuid, addr, port = re.split(r"[:@]", header)
+            method_uuid, addr, port = USERINFO_PATTERN.split(header)
             method, uuid = base64_decode(method_uuid).split(":", 1)
             note = self._remove_code(urllib.parse.unquote(footer))
 
@@ -128,18 +265,37 @@ class ProtocolB:
     PROTOCOL = b"\x76\x6d\x65\x73\x73".decode()
 
     def _remove_code(self, text):
-        filter_text = re.sub(r"\\ud[0-9a-fA-F]{4}", "", text)
+        # json.loads() joins escaped surrogate pairs into real emoji
+        filter_text = EMOJI_PATTERN.sub("", SURROGATE_PATTERN.sub("", text))
 
         try:
             return filter_text.encode("utf-8", "ignore").decode("utf-8", "ignore")
         except UnicodeDecodeError:
             return ""
 
-    def decode(self, link):
-        body = link.replace(self.NAME, "")
-        decoded_body = base64_decode(body)
-        decoded_body = eval(decoded_body)
+    def _loads(self, text):
+        """
+        Parse one vmess payload, the payload should be JSON but providers
+        also send trailing commas or python-style (single quoted) dicts
+        """
+        text = text.strip().lstrip("\ufeff")
+
+        try:
+            return JSON_DECODER.decode(text)
+        except ValueError:
+            pass
 
+        try:
+            return JSON_DECODER.decode(TRAILING_COMMA_PATTERN.sub(r"\1", text))
+        except ValueError:
+            pass
+
+        try:
+            return ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            raise ValueError(f"Invalid {self.PROTOCOL} payload: {text[:32]}...")
+
+    def _server(self, decoded_body):
         return {
             "uuid": decoded_body["id"],
             "port": decoded_body["port"],
@@ -148,21 +304,34 @@ class ProtocolB:
             "note": self._remove_code(decoded_body["ps"]),
         }
 
+    def decode(self, link):
+        body = link.replace(self.NAME, "")
+        return self._server(self._loads(base64_decode(body)))
+
+    def decode_batch(self, links):
+        """
+        Decode a list of vmess links in one call, the payloads are joined into
+        a single JSON array and parsed at once, links that break the array
+        fall back to the tolerant per-link path
+        """
+        payloads = [base64_decode(link.replace(self.NAME, "")) for link in links]
+
+        try:
+            decoded_bodies = JSON_DECODER.decode(f"[{','.join(payloads)}]")
+            if len(decoded_bodies) != len(payloads):
+                raise ValueError("payload count mismatch")
+        except ValueError:
+            decoded_bodies = [self._loads(payload) for payload in payloads]
+
+        return [self._server(decoded_body) for decoded_body in decoded_bodies]
+
 
 class ProtocolC:
     NAME = b"\x74\x72\x6f\x6a\x61\x6e\x3a\x2f\x2f".decode()
     PROTOCOL = b"\x74\x72\x6f\x6a\x61\x6e".decode()
 
     def _remove_code(self, text):
-        return re.compile(
-            "["
-            "\U0001F600-\U0001F64F"
-            "\U0001F300-\U0001F5FF"
-            "\U0001F680-\U0001F6FF"
-            "\U0001F1E0-\U0001F1FF"
-            "]+",
-            flags=re.UNICODE,
-        ).sub(r"", text)
+        return EMOJI_PATTERN.sub(r"", text)
 
     def decode(self, link):
         body = link.replace(self.NAME, "").replace("\r", "")
@@ -173,7 +342,7 @@ class ProtocolC:
                            item1 & item2 & ...
         """
 
-        uuid, addr, port, config, note = re.split(r"[@:?#]", body)
+        uuid, addr, port, config, note = URI_PATTERN.split(body)
 
         params = urllib.parse.parse_qs(config)
 
@@ -198,15 +367,7 @@ class ProtocolD:
     PROTOCOL = b"\x68\x79\x73\x74\x65\x72\x69\x61\x32".decode()
 
     def _remove_code(self, text):
-        return re.compile(
-            "["
-            "\U0001F600-\U0001F64F"
-            "\U0001F300-\U0001F5FF"
-            "\U0001F680-\U0001F6FF"
-            "\U0001F1E0-\U0001F1FF"
-            "]+",
-            flags=re.UNICODE,
-        ).sub(r"", text)
+        return EMOJI_PATTERN.sub(r"", text)
 
     def decode(self, link):
         body = link.replace(self.NAME, "").replace("\r", "")
@@ -217,13 +378,15 @@ class ProtocolD:
                            item1 & item2 & ...
         """
 
-        uuid, addr, port, config, note = re.split(r"[@:?#]", body)
+        uuid, addr, port, config, note = URI_PATTERN.split(body)
 
         params = urllib.parse.parse_qs(config)
 
         insecure = bool(int(params.get("insecure", ["0"])[0]))
         security = params.get("security", [""])[0]
         sni = params.get("sni", [""])[0]
+        obfs = params.get("obfs", [""])[0]
+        obfs_password = params.get("obfs-password", [""])[0]
 
         return {
             "uuid": uuid,
@@ -234,6 +397,8 @@ class ProtocolD:
             "insecure": insecure,
             "security": security,
             "sni": sni,
+            "obfs": obfs,
+            "obfs-password": obfs_password,
         }
 
 
@@ -242,15 +407,7 @@ class ProtocolE:
     PROTOCOL = b"\x76\x6c\x65\x73\x73".decode()
 
     def _remove_code(self, text):
-        return re.compile(
-            "["
-            "\U0001F600-\U0001F64F"
-            "\U0001F300-\U0001F5FF"
-            "\U0001F680-\U0001F6FF"
-            "\U0001F1E0-\U0001F1FF"
-            "]+",
-            flags=re.UNICODE,
-        ).sub(r"", text)
+        return EMOJI_PATTERN.sub(r"", text)
 
     def decode(self, link):
         body = link.replace(self.NAME, "").replace("\r", "")
@@ -261,7 +418,7 @@ class ProtocolE:
                            item1 & item2 & ...
         """
 
-        uuid, addr, port, config, note = re.split(r"[@:?#]", body)
+        uuid, addr, port, config, note = URI_PATTERN.split(body)
 
         params = urllib.parse.parse_qs(config)
 
@@ -278,80 +435,215 @@ class ProtocolE:
         return main
 
 
+REGIONS = {
+    "hk": ("香港", "Hong Kong", "HongKong", "HK"),
+    "tw": ("台湾", "臺灣", "Taiwan", "TW"),
+    "jp": ("日本", "东京", "大阪", "Japan", "Tokyo", "Osaka", "JP"),
+    "sg": ("新加坡", "狮城", "Singapore", "SG"),
+    "us": ("美国", "洛杉矶", "硅谷", "United States", "Los Angeles", "USA", "US"),
+    "kr": ("韩国", "首尔", "Korea", "Seoul", "KR"),
+    "gb": ("英国", "伦敦", "United Kingdom", "London", "UK", "GB"),
+    "de": ("德国", "法兰克福", "Germany", "Frankfurt", "DE"),
+    "fr": ("法国", "巴黎", "France", "Paris", "FR"),
+    "nl": ("荷兰", "Netherlands", "NL"),
+    "ca": ("加拿大", "Canada", "CA"),
+    "au": ("澳大利亚", "澳洲", "Australia", "AU"),
+    "ru": ("俄罗斯", "Russia", "RU"),
+    "in": ("印度", "India", "IN"),
+    "tr": ("土耳其", "Turkey", "TR"),
+    "my": ("马来西亚", "Malaysia", "MY"),
+    "th": ("泰国", "Thailand", "TH"),
+    "vn": ("越南", "Vietnam", "VN"),
+    "ph": ("菲律宾", "Philippines", "PH"),
+    "ar": ("阿根廷", "Argentina", "AR"),
+}
+REGION_ALIASES = {
+    alias.lower(): region for region, aliases in REGIONS.items() for alias in aliases
+}
+# Upper-case codes only match on their own ("HK01", "HK-01"), names ignore case
+REGION_PATTERN = re.compile(
+    "|".join(
+        (
+            f"(?<![A-Za-z]){alias}(?![A-Za-z])"
+            if alias.isupper()
+            else f"(?i:{re.escape(alias)})"
+        )
+        for aliases in REGIONS.values()
+        for alias in aliases
+    )
+)
+
+
+PROTOCOLS = {
+    protocol.NAME: protocol()
+    for protocol in (ProtocolA, ProtocolB, ProtocolC, ProtocolD, ProtocolE)
+}
+
+# Fields telling two servers apart besides protocol, addr, port and uuid
+IDENTITY_FIELDS = {
+    ProtocolA.PROTOCOL: ("method",),
+    ProtocolB.PROTOCOL: (),
+    ProtocolC.PROTOCOL: ("allowInsecure", "peer", "sni"),
+    ProtocolD.PROTOCOL: ("insecure", "security", "sni", "obfs", "obfs-password"),
+    ProtocolE.PROTOCOL: (
+        "type",
+        "security",
+        "encryption",
+        "flow",
+        "serviceName",
+        "mode",
+        "path",
+        "host",
+        "headerType",
+        "alpn",
+        "sni",
+        "fp",
+        "pbk",
+        "sid",
+    ),
+}
+
+
 class Sub2Json:
     def __init__(self, data: bytes) -> None:
         self.__data = data
         pass
 
+    def _iter_links(self):
+        """
+        Decode the base64 string chunk by chunk and yield one protocol string
+        at a time, the decoded subscription is never held in memory at once
+        """
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        pending = b""
+        tail = ""
+
+        try:
+            for offset in range(0, len(self.__data), B64_CHUNK_SIZE):
+                start = time.perf_counter()
+                chunk = pending + B64_NOISE_PATTERN.sub(
+                    b"", self.__data[offset : offset + B64_CHUNK_SIZE]
+                )
+                cut = len(chunk) - len(chunk) % 4
+                pending = chunk[cut:]
+
+                *links, tail = (
+                    tail + decoder.decode(base64.b64decode(chunk[:cut]))
+                ).split("\n")
+                links = list(filter(None, map(str.strip, links)))
+                STATS.add("predecode", time.perf_counter() - start, len(links), cut)
+                yield from links
+
+            start = time.perf_counter()
+            pending += b"=" * (-len(pending) % 4)
+            tail += decoder.decode(base64.b64decode(pending), final=True)
+
+        except (binascii.Error, UnicodeDecodeError) as e:
+            raise ValueError(f"Invalid subscription data: {e}") from e
+
+        links = list(filter(None, map(str.strip, tail.split("\n"))))
+        STATS.add("predecode", time.perf_counter() - start, len(links), len(pending))
+        yield from links
+
     def _predecode(self):
         """
         First decode the base64 string into multiple protocol strings
         """
-        try:
-            result = base64.b64decode(self.__data).decode("utf-8")
+        return list(self._iter_links())
 
-        except Exception:
-            exit(1)
+    def iter_decode(self):
+        # Per protocol [seconds, links], flushed once instead of per link
+        timings = {}
 
-        return result.strip().split("\n")
+        try:
+            for link in self._iter_links():
+                index = link.find("://")
+                protocol = PROTOCOLS.get(link[: index + 3]) if index > 0 else None
+
+                if protocol is not None:
+                    start = time.perf_counter()
+                    server = protocol.decode(link)
+                    timing = timings.setdefault(protocol.PROTOCOL, [0.0, 0])
+                    timing[0] += time.perf_counter() - start
+                    timing[1] += 1
+                    yield server
+                    continue
+
+                name = link[:index] if index > 0 else link
+                print(f"{name} is not implemented")
+                hex_str = "".join(f"\\x{byte:02x}" for byte in name.encode("utf-8"))
+                print(f'NAME = b"{hex_str}\\x3a\\x2f\\x2f".decode()')
+                print(f'PROTOCOL = b"{hex_str}".decode()')
+
+        finally:
+            for name, (seconds, count) in timings.items():
+                STATS.add(f"decode.{name}", seconds, count)
 
     def decode(self):
-        protocols = {
-            ProtocolA.NAME: ProtocolA(),
-            ProtocolB.NAME: ProtocolB(),
-            ProtocolC.NAME: ProtocolC(),
-            ProtocolD.NAME: ProtocolD(),
-            ProtocolE.NAME: ProtocolE(),
-        }
+        return list(self.iter_decode())
 
-        data = []
-        for link in self._predecode():
-            found = False
-            for name, obj in protocols.items():
-                if link.startswith(name):
-                    found = True
-                    data.append(obj.decode(link))
-            if not found:
-                protocol, _ = re.split(r"://", link)
-                print(f"{protocol} is not implemented")
-                hex_str = "".join(f"\\x{byte:02x}" for byte in protocol.encode("utf-8"))
-                print(f'NAME = b"{hex_str}\\x3a\\x2f\\x2f".decode()')
-                print(f'PROTOCOL = b"{hex_str}".decode()')
 
-        return data
+def identity_key(server):
+    """
+    Fixed per-protocol identity of a server, list values (parse_qs output)
+    are joined instead of sorted recursively
+    """
+    protocol = server.get("protocol")
+    fields = IDENTITY_FIELDS.get(protocol)
+    if fields is None:
+        fields = sorted(k for k in server if k not in ("index", "note"))
+
+    values = [protocol, server.get("addr"), server.get("port"), server.get("uuid")]
+    for field in fields:
+        value = server.get(field)
+        if isinstance(value, list):
+            value = ",".join(map(str, value))
+        values.append(value)
 
+    return "\x1f".join("" if value is None else str(value) for value in values)
 
-def canonical(v):
-    import math
 
-    if isinstance(v, dict):
-        return tuple((k, canonical(v[k])) for k in sorted(v))
+def fingerprint(server) -> bytes:
+    return hashlib.blake2b(identity_key(server).encode("utf-8"), digest_size=8).digest()
 
-    if isinstance(v, (list, tuple, set)):
-        return tuple(sorted(canonical(x) for x in v))
 
-    if isinstance(v, float):
-        if math.isnan(v):
-            return ("NaN",)
-        return round(v, 8)
+class Deduplicator:
+    """
+    Set of server fingerprints, one instance shared by every subscription
+    collapses duplicates across providers
+    """
 
-    if isinstance(v, bytes):
-        return ("bytes", v.hex())
+    def __init__(self) -> None:
+        self.seen = set()
+        self.stats = {}
 
-    return v
+    def seed(self, fingerprints):
+        self.seen.update(fingerprints)
 
+    def filter(self, servers, source=None):
+        stats = self.stats.setdefault(source, {"servers": 0, "duplicates": 0})
 
-def dedup_dicts(dicts, exclude_keys=("index", "note")):
-    seen = set()
-    result = []
+        for server in servers:
+            key = fingerprint(server)
+            if key in self.seen:
+                stats["duplicates"] += 1
+                continue
 
-    for d in dicts:
-        key = canonical({k: d[k] for k in d if k not in exclude_keys})
-        if key not in seen:
-            seen.add(key)
-            result.append(d)
+            self.seen.add(key)
+            stats["servers"] += 1
+            yield server
 
-    return result
+    def report(self):
+        for source, stats in self.stats.items():
+            print(
+                f"{source or 'subscription'}: {stats['servers']} servers, "
+                f"{stats['duplicates']} duplicates"
+            )
+
+
+def dedup_dicts(dicts, dedup=None, source=None):
+    dedup = Deduplicator() if dedup is None else dedup
+    return list(dedup.filter(dicts, source))
 
 
 def args_parse():
@@ -364,6 +656,9 @@ def args_parse():
         "  # Use local subscription data from (\033[1;34mFILE\033[0m) and save to (\033[1;34mDIR\033[0m)\n"
         "  \033[1;32m$ python3 sub2json.py -r ~/.cache/subscribe.data -o ~/.cache\033[0m\n"
         "\n"
+        "  # Fetch every subscribe entry of (\033[1;34mFILE\033[0m) concurrently, each saved to its dir\n"
+        "  \033[1;32m$ python3 sub2json.py -c ~/.config/multi-client-config.yml\033[0m\n"
+        "\n"
     )
 
     parser = ArgumentParser(
@@ -389,47 +684,402 @@ def args_parse():
     )
 
     parser.add_argument(
-        "-o", "--outdir", metavar="DIR", required=True, help="Path to outdir"
+        "-c",
+        "--config",
+        metavar="FILE",
+        required=False,
+        help="Path to multi-client-config.yml, convert every subscribe entry",
+    )
+
+    parser.add_argument(
+        "-o", "--outdir", metavar="DIR", required=False, help="Path to outdir"
+    )
+
+    fetch = parser.add_argument_group("fetch Options")
+    fetch.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        default=4,
+        type=int,
+        help="Number of subscriptions fetched at once (--config only)",
+    )
+    fetch.add_argument(
+        "--timeout",
+        metavar="SECONDS",
+        default=10,
+        type=float,
+        help="Connect and read timeout of every request",
+    )
+    fetch.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="Ignore the fetch cache and always convert the subscription",
+    )
+
+    debug = parser.add_argument_group("debug Options")
+    debug.add_argument(
+        "--stats",
+        metavar="FILE",
+        required=False,
+        help="Dump per-stage time, bytes and item counts as JSON to FILE (- for stderr)",
+    )
+    debug.add_argument(
+        "--profile",
+        metavar="FILE",
+        required=False,
+        help="Run under cProfile and save the pstats to FILE",
     )
 
     args = parser.parse_args()
 
-    if (args.subscribe and args.rawcontent) or (
-        not args.subscribe and not args.rawcontent
-    ):
-        parser.error("You must specify exactly one of --subscribe or --rawcontent.")
+    if [bool(args.subscribe), bool(args.rawcontent), bool(args.config)].count(
+        True
+    ) != 1:
+        parser.error(
+            "You must specify exactly one of --subscribe, --rawcontent or --config."
+        )
+
+    if not args.config and not args.outdir:
+        parser.error("--outdir is required with --subscribe or --rawcontent.")
+
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer.")
 
     return args
 
 
-def main():
-    args = args_parse()
+def save_subscribe(data, outdir):
+    cached_subscribe = os.path.join(outdir, "subscribe.data")
+    print(f"Writing subscribe data (rawcontent) at {cached_subscribe}")
+    with open(cached_subscribe, "wb") as f:
+        f.write(data)
 
-    if args.rawcontent:
-        data = open(args.rawcontent, "rb").read()
-    else:
-        if not args.subscribe:
-            print("must specified --subscribe or --rawcontent")
-            exit(1)
-
-        data = subscribe(url=args.subscribe)
-        cached_subscribe = os.path.join(args.outdir, "subscribe.data")
-        print(f"Writing subscribe data (rawcontent) at {cached_subscribe}")
-        with open(cached_subscribe, "wb") as f:
+
+def load_subscribe(outdir):
+    """
+    The subscribe data saved by the last conversion, None if there is none
+    """
+    try:
+        with open(os.path.join(outdir, "subscribe.data"), "rb") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def write_atomic(path, data: bytes):
+    start = time.perf_counter()
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=".", suffix=".tmp"
+    )
+
+    try:
+        with os.fdopen(fd, "wb") as f:
             f.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    STATS.add("write", time.perf_counter() - start, 1, len(data))
+
+
+def server_id(server):
+    """
+    Stable ID of a server, the hex form of its dedup fingerprint
+    """
+    return fingerprint(server).hex()
+
+
+class ServerWriter:
+    """
+    Keeps every serverNN.json bound to the same server across refreshes, a
+    new server takes a number never used before (the manifest keeps the
+    high-water mark) and only changed files are rewritten
+    """
+
+    def __init__(self, outdir) -> None:
+        self.outdir = outdir
+        self.path = os.path.join(outdir, MANIFEST_FILE)
+        self.legacy = False
+
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            self.manifest = manifest["servers"]
+        except (OSError, ValueError, KeyError):
+            # Files of the positional layout, before the manifest existed
+            self.legacy = True
+            manifest, self.manifest = {}, {}
+
+        used = [entry["index"] for entry in self.manifest.values()]
+        self.next_index = manifest.get("next_index") or max(used, default=0) + 1
+
+    def fingerprints(self):
+        return [bytes.fromhex(sid) for sid in self.manifest]
 
-    count = 0
-    servers = dedup_dicts(Sub2Json(data).decode(), ("note"))
-    for server in servers:
-        count += 1
-        filename = os.path.join(args.outdir, f"server{count:02d}.json")
-        with open(filename, "w", encoding="utf-8") as f:
-            server["index"] = count
-            json.dump(server, f, indent=4, ensure_ascii=False)
+    def _filename(self, index):
+        return os.path.join(self.outdir, f"server{index:02d}.json")
+
+    def write(self, servers):
+        servers = {server_id(server): server for server in servers}
+
+        manifest = {
+            sid: entry for sid, entry in self.manifest.items() if sid in servers
+        }
+        used = {entry["index"] for entry in manifest.values()}
+
+        unchanged = 0
+        for sid, server in servers.items():
+            if sid not in manifest:
+                used.add(self.next_index)
+                manifest[sid] = {"index": self.next_index, "sha256": None}
+                self.next_index += 1
+
+            entry = manifest[sid]
+            server["index"] = entry["index"]
+            filename = self._filename(entry["index"])
+
+            data = json.dumps(server, indent=4, ensure_ascii=False).encode("utf-8")
+            sha256 = hashlib.sha256(data).hexdigest()
+            if entry["sha256"] == sha256 and os.path.exists(filename):
+                unchanged += 1
+                continue
+
+            write_atomic(filename, data)
+            entry["sha256"] = sha256
             print(
-                f"Output file saved at \033[1;32m{os.path.realpath(f.name)}\033[0m ({count:02d}: {server['note']})"
+                f"Output file saved at \033[1;32m{os.path.realpath(filename)}\033[0m ({entry['index']:02d}: {server['note']})"
             )
 
+        stale = [
+            self._filename(entry["index"])
+            for sid, entry in self.manifest.items()
+            if sid not in manifest and entry["index"] not in used
+        ]
+        if self.legacy:
+            stale += [
+                os.path.join(self.outdir, name)
+                for name in sorted(os.listdir(self.outdir))
+                if SERVER_FILE_PATTERN.fullmatch(name)
+                and int(SERVER_FILE_PATTERN.fullmatch(name).group(1)) not in used
+            ]
+        for filename in stale:
+            if os.path.exists(filename):
+                os.remove(filename)
+                print(f"Removed stale server file {os.path.realpath(filename)}")
+
+        self.manifest = dict(sorted(manifest.items(), key=lambda x: x[1]["index"]))
+        self.legacy = False
+        data = json.dumps(
+            {"next_index": self.next_index, "servers": self.manifest}, indent=4
+        ).encode("utf-8")
+        write_atomic(self.path, data)
+
+        print(f"{unchanged} of {len(servers)} server files unchanged")
+
+        write_catalog(
+            self.outdir,
+            [
+                (sid, servers[sid], entry["index"])
+                for sid, entry in self.manifest.items()
+            ],
+        )
+
+
+def parse_region(note):
+    match = REGION_PATTERN.search(note or "")
+    return REGION_ALIASES[match.group(0).lower()] if match else None
+
+
+def write_catalog(outdir, entries):
+    """
+    Write every server as one compact line of servers.jsonl, the index maps
+    each stable ID to its (offset, length) and lists the IDs per file,
+    protocol and region, so a single server is read with one seek
+    """
+    lines = []
+    index = {
+        "catalog": CATALOG_FILE,
+        "id": {},
+        "file": {},
+        "protocol": {},
+        "region": {},
+    }
+
+    offset = 0
+    for sid, server, number in entries:
+        line = (json.dumps(server, ensure_ascii=False) + "\n").encode("utf-8")
+        lines.append(line)
+
+        index["id"][sid] = [offset, len(line)]
+        index["file"][f"server{number:02d}.json"] = sid
+        index["protocol"].setdefault(server["protocol"], []).append(sid)
+        region = parse_region(server.get("note"))
+        if region is not None:
+            index["region"].setdefault(region, []).append(sid)
+        offset += len(line)
+
+    write_atomic(os.path.join(outdir, CATALOG_FILE), b"".join(lines))
+    write_atomic(
+        os.path.join(outdir, CATALOG_INDEX_FILE),
+        json.dumps(index, ensure_ascii=False).encode("utf-8"),
+    )
+
+
+def load_subscribe_config(path):
+    import yaml
+
+    with open(os.path.expanduser(path), "r", encoding="utf-8") as f:
+        config = yaml.safe_load(f) or {}
+
+    sources = config.get("subscribe") or []
+    for source in sources:
+        assert source.get("dir"), f"subscribe entry {source.get('name')} has no dir"
+        assert source.get("url") or source.get(
+            "raw"
+        ), f"subscribe entry {source.get('name')} has neither url nor raw"
+        source["dir"] = os.path.expanduser(source["dir"])
+
+    return sources
+
+
+def fetch_source(source, session, timeout, force=False):
+    """
+    Returns (data, cache), data is None if the subscription did not change
+    since the last conversion, raw files are always converted
+    """
+    with STATS.stage("fetch") as stage:
+        if source.get("raw"):
+            with open(os.path.expanduser(source["raw"]), "rb") as f:
+                data = f.read()
+            stage.add(items=1, nbytes=len(data))
+            return data, None
+
+        cache = FetchCache(source["dir"])
+        if force:
+            cache.clear()
+
+        data = subscribe(
+            url=source["url"], session=session, timeout=timeout, cache=cache
+        )
+        stage.add(items=1, nbytes=0 if data is None else len(data))
+
+    if data is not None and cache.unchanged(data):
+        os.makedirs(source["dir"], exist_ok=True)
+        cache.save()
+        data = None
+
+    return data, cache
+
+
+def convert_all(sources, jobs=4, timeout=(10, 10), session=None, force=False):
+    """
+    Fetch every subscription at once and decode each one as soon as its
+    response arrives, returns the names of the sources that failed
+
+    Dedup and writing follow the config order, so a server offered by
+    several providers always stays with the first one listed
+    """
+    session = create_session(jobs) if session is None else session
+    results = {}
+    failed = {}
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(fetch_source, source, session, timeout, force): i
+            for i, source in enumerate(sources)
+        }
+
+        for future in as_completed(futures):
+            i = futures[future]
+            name = sources[i].get("name", sources[i]["dir"])
+
+            try:
+                data, cache = future.result()
+            except (ValueError, OSError) as e:
+                print(f"\033[1;31m{name}: {e}\033[0m")
+                failed[i] = name
+                continue
+
+            if data is None:
+                print(f"Subscription \033[1;32m{name}\033[0m is unchanged, skipped")
+                continue
+
+            print(f"Decoding subscription \033[1;32m{name}\033[0m")
+            try:
+                results[i] = (data, cache, list(Sub2Json(data).iter_decode()))
+            except ValueError as e:
+                print(f"\033[1;31m{name}: {e}\033[0m")
+                failed[i] = name
+
+    # Which copy of a duplicate survives depends on every source before it,
+    # a changed source dedups the unchanged ones again from their saved data
+    # so a server dropped as a duplicate comes back once its first copy goes
+    if results:
+        for i, source in enumerate(sources):
+            if i in results or i in failed:
+                continue
+            data = load_subscribe(source["dir"])
+            if data is None:
+                continue
+            try:
+                results[i] = (data, None, list(Sub2Json(data).iter_decode()))
+            except ValueError:
+                # Its server files stay, they are seeded below
+                pass
+
+    dedup = Deduplicator()
+    for i, source in enumerate(sources):
+        name = source.get("name", source["dir"])
+
+        if i not in results:
+            # Failed (or nothing changed), its server files stay as they are
+            dedup.seed(ServerWriter(source["dir"]).fingerprints())
+            continue
+
+        data, cache, servers = results[i]
+        print(f"Converting subscription \033[1;32m{name}\033[0m")
+        os.makedirs(source["dir"], exist_ok=True)
+        if cache is not None:
+            save_subscribe(data, source["dir"])
+        with STATS.stage("dedup") as stage:
+            servers = dedup_dicts(servers, dedup, name)
+            stage.add(items=len(servers))
+        ServerWriter(source["dir"]).write(servers)
+        if cache is not None:
+            cache.commit(data)
+
+    dedup.report()
+
+    return list(failed.values())
+
+
+def main():
+    args = args_parse()
+    timeout = (args.timeout, args.timeout)
+
+    if args.config:
+        sources = load_subscribe_config(args.config)
+        jobs = args.jobs
+    elif args.rawcontent:
+        sources = [{"raw": args.rawcontent, "dir": args.outdir}]
+        jobs = 1
+    else:
+        sources = [{"url": args.subscribe, "dir": args.outdir}]
+        jobs = 1
+
+    with profiled(args.profile):
+        failed = convert_all(sources, jobs, timeout, force=args.force)
+
+    if args.stats:
+        STATS.dump(args.stats)
+
+    if failed:
+        print(f"\033[1;31mFailed subscriptions: {', '.join(failed)}\033[0m")
+        exit(1)
+
     print("Subscribe conversion: \033[1;32mCompleted\033[0m")
 
 
@@ -3,12 +3,188 @@
 # Date: 2024-12-14
 # Description: This is a Python script for ProjectV config builder
 
+import io
+import os
 import json
+import time
+import socket
+import gzip
+import hashlib
+import tarfile
+import tempfile
+import ipaddress
+from types import MappingProxyType
+from typing import NamedTuple, Optional
+from metrics import STATS, profiled
 
 GLOBAL_RULES_PATH = "~/.v2rules.json"
 
+# Written by sub2json.py next to the serverNN.json files
+CATALOG_FILE = "servers.jsonl"
+CATALOG_INDEX_FILE = "servers.index.json"
+RANKING_FILE = "ranking.json"
+
+# sha256sum compatible list of the configs built by --clusters
+CONFIGS_MANIFEST_FILE = "configs.sha256"
+
+# --bundle archive: the manifest of deploy.py, the configs, and the image
+# pins and deploy.py shipped next to this script
+BUNDLE_MANIFEST_FILE = "manifest.json"
+BUNDLE_SCRIPTS = ("deploy.py",)
+BUNDLE_SHA256_DIR = "sha256"
+BUNDLE_SIDECAR_PIN = "hysteria"
+
+# Sections of ~/.v2rules.json and the lists each one must have
+RULES_SECTIONS = {
+    "direct_1st": ("domain",),
+    "proxy_1st": ("domain",),
+    "direct_2nd": ("domain", "source"),
+    "proxy_2nd": ("domain", "source"),
+    "proxy_3rd": ("source",),
+}
+
+# Domain matchers by rough cost, geosite and ext lists are opaque
+DOMAIN_COST = {"full": 0, "domain": 1, "keyword": 2, "regexp": 3}
+RULE_COST = {"domain": 0, "source": 1, "ip": 2, "port": 3}
+
+# Transport tuning of the proxy outbounds, grpc applies to gRPC transports,
+# sockopt to every proxy outbound and hysteria2 to the hysteria2 sidecar
+# (the bandwidth hints switch it to Brutal congestion control)
+TUNING_PROFILES = {
+    "default": {
+        "grpc": {
+            "multiMode": False,
+            "idle_timeout": 60,
+            "health_check_timeout": 20,
+            "permit_without_stream": False,
+            "initial_windows_size": 0,
+        },
+        "sockopt": {},
+        "hysteria2": {
+            "bandwidth": {"up": "20 mbps", "down": "100 mbps"},
+            "quic": {
+                "initStreamReceiveWindow": 8388608,
+                "maxStreamReceiveWindow": 8388608,
+                "initConnReceiveWindow": 20971520,
+                "maxConnReceiveWindow": 20971520,
+                "maxIdleTimeout": "30s",
+                "keepAlivePeriod": "10s",
+            },
+        },
+    },
+    "throughput": {
+        "grpc": {
+            "multiMode": True,
+            "idle_timeout": 60,
+            "health_check_timeout": 20,
+            "permit_without_stream": False,
+            "initial_windows_size": 1048576,
+        },
+        "sockopt": {
+            "tcpFastOpen": True,
+            "tcpKeepAliveIdle": 60,
+            "tcpKeepAliveInterval": 30,
+        },
+        "hysteria2": {
+            "bandwidth": {"up": "50 mbps", "down": "500 mbps"},
+            "quic": {
+                "initStreamReceiveWindow": 16777216,
+                "maxStreamReceiveWindow": 16777216,
+                "initConnReceiveWindow": 41943040,
+                "maxConnReceiveWindow": 41943040,
+                "maxIdleTimeout": "30s",
+                "keepAlivePeriod": "10s",
+            },
+        },
+    },
+    "latency": {
+        "grpc": {
+            "multiMode": True,
+            "idle_timeout": 30,
+            "health_check_timeout": 10,
+            "permit_without_stream": True,
+            "initial_windows_size": 0,
+        },
+        "sockopt": {
+            "tcpFastOpen": True,
+            "tcpKeepAliveIdle": 30,
+            "tcpKeepAliveInterval": 15,
+        },
+        "hysteria2": {
+            "bandwidth": {"up": "20 mbps", "down": "100 mbps"},
+            "quic": {
+                "initStreamReceiveWindow": 8388608,
+                "maxStreamReceiveWindow": 8388608,
+                "initConnReceiveWindow": 20971520,
+                "maxConnReceiveWindow": 20971520,
+                "maxIdleTimeout": "20s",
+                "keepAlivePeriod": "5s",
+            },
+        },
+    },
+    "mobile": {
+        "grpc": {
+            "multiMode": False,
+            "idle_timeout": 20,
+            "health_check_timeout": 10,
+            "permit_without_stream": True,
+            "initial_windows_size": 0,
+        },
+        # Fast Open is often dropped by carrier middleboxes
+        "sockopt": {
+            "tcpFastOpen": False,
+            "tcpKeepAliveIdle": 15,
+            "tcpKeepAliveInterval": 10,
+        },
+        "hysteria2": {
+            "bandwidth": {"up": "10 mbps", "down": "50 mbps"},
+            "quic": {
+                "initStreamReceiveWindow": 8388608,
+                "maxStreamReceiveWindow": 8388608,
+                "initConnReceiveWindow": 20971520,
+                "maxConnReceiveWindow": 20971520,
+                "maxIdleTimeout": "15s",
+                "keepAlivePeriod": "5s",
+            },
+        },
+    },
+}
+
+# hysteria2 runs in a sidecar client sharing the network of the proxy
+# container, the proxy outbound reaches it over socks on loopback
+HYSTERIA2_SOCKS_PORT = 1080
+SIDECAR_SUFFIX = ".hysteria2.json"
+
+# One config with several servers balances them, the observatory probe key
+# is spelled differently by the clients
+BALANCER_TAG = "proxy"
+BALANCER_STRATEGIES = ("leastPing", "random")
+OBSERVATORY_PROBE_KEY = {"v2fly": "probeURL", "xray": "probeUrl"}
+
+# Built-in DNS, domains routed direct are resolved by the domestic servers
+# and everything else by the foreign ones, which are reached through the proxy
+DNS_QUERY_STRATEGIES = ("UseIP", "UseIPv4", "UseIPv6")
+DNS_DOMESTIC_SERVERS = ("223.5.5.5", "119.29.29.29")
+DNS_FOREIGN_SERVERS = ("1.1.1.1", "8.8.8.8")
+
+# Server hostnames resolved at build time with --resolve, cached on disk
+RESOLVE_CACHE_FILE = "~/.cache/v2builder.resolve.json"
+RESOLVE_TTL = 3600
+
+# mux.cool concurrency bounds of the clients, 0 disables mux
+MUX_MAX_CONCURRENCY = 1024
+
+# Compiled routing per (path, mtime, size), the rules file is parsed once,
+# bump the version when compile_routing() output changes
+ROUTING_CACHE_VERSION = 2
+_ROUTING_CACHE = {}
+
 
 class BaseServerProtocol:
+    # mux.cool needs a v2fly/xray server, xudp an xray vmess/vless one
+    MUX = False
+    XUDP = False
+
     def __init__(
         self,
         server_address: str,
@@ -16,12 +192,17 @@ class BaseServerProtocol:
         server_uuid: str,
         server_method: str,
         server_data,
+        tuning="default",
     ):
         self.server_address = server_address
         self.server_port = server_port
         self.server_uuid = server_uuid
         self.server_method = server_method
         self.server_data = server_data
+        self.tuning = TUNING_PROFILES[tuning]
+
+    def outbound(self):
+        return self.NAME
 
     def settings(self):
         raise NotImplementedError("Subclasses must implement settings method.")
@@ -29,6 +210,19 @@ class BaseServerProtocol:
     def streamSettings(self):
         raise NotImplementedError("Subclasses must implement streamSettings method.")
 
+    def sidecar(self):
+        return None
+
+    def mux(self, concurrency, client="v2fly"):
+        if not self.MUX or concurrency <= 0:
+            return None
+
+        data = {"enabled": True, "concurrency": concurrency}
+        if self.XUDP and client == "xray":
+            data["xudpConcurrency"] = concurrency
+
+        return data
+
 
 class ServerProtocolA(BaseServerProtocol):
     NAME = b"\x73\x68\x61\x64\x6f\x77\x73\x6f\x63\x6b\x73".decode()
@@ -53,6 +247,8 @@ class ServerProtocolA(BaseServerProtocol):
 
 class ServerProtocolB(BaseServerProtocol):
     NAME = b"\x76\x6d\x65\x73\x73".decode()
+    MUX = True
+    XUDP = True
 
     def settings(
         self,
@@ -80,6 +276,7 @@ class ServerProtocolB(BaseServerProtocol):
 
 class ServerProtocolC(BaseServerProtocol):
     NAME = b"\x74\x72\x6f\x6a\x61\x6e".decode()
+    MUX = True
 
     def settings(
         self,
@@ -102,13 +299,215 @@ class ServerProtocolC(BaseServerProtocol):
             "security": "tls",
             "tlsSettings": {
                 "allowInsecure": self.server_data.get("allowInsecure"),
-                "serverName": self.server_data.get("sni"),
+                "serverName": self.server_data.get("sni") or self.server_address,
             },
         }
 
 
+class ServerProtocolD(BaseServerProtocol):
+    """
+    Neither client image speaks hysteria2, the outbound is a socks hop to a
+    hysteria client sidecar, sidecar() returns its config
+    """
+
+    NAME = b"\x68\x79\x73\x74\x65\x72\x69\x61\x32".decode()
+
+    def outbound(self):
+        return "socks"
+
+    def settings(self):
+        return {
+            "servers": [
+                {
+                    "address": "127.0.0.1",
+                    "port": HYSTERIA2_SOCKS_PORT,
+                }
+            ]
+        }
+
+    def streamSettings(self):
+        return {}
+
+    def sidecar(self):
+        address = self.server_address
+        if ":" in address:
+            address = f"[{address}]"
+
+        data = {
+            "server": f"{address}:{self.server_port}",
+            "auth": self.server_uuid,
+            "tls": {
+                "sni": self.server_data.get("sni") or self.server_address,
+                "insecure": bool(self.server_data.get("insecure")),
+            },
+            "bandwidth": dict(self.tuning["hysteria2"]["bandwidth"]),
+            "quic": dict(self.tuning["hysteria2"]["quic"]),
+            "socks5": {"listen": f"127.0.0.1:{HYSTERIA2_SOCKS_PORT}"},
+        }
+
+        if self.server_data.get("obfs") == "salamander":
+            data["obfs"] = {
+                "type": "salamander",
+                "salamander": {"password": self.server_data.get("obfs-password")},
+            }
+
+        return data
+
+
+def first(value, default=""):
+    """
+    vless parameters are parse_qs() lists, the other protocols plain values
+    """
+    if isinstance(value, list):
+        return value[0] if value else default
+    return default if value is None else value
+
+
+# vless streamSettings builders by the type= and security= link parameters,
+# each one returns the keys it adds to streamSettings
+VLESS_TRANSPORTS = {}
+VLESS_SECURITIES = {}
+
+
+def vless_transport(*names):
+    def register(func):
+        for name in names:
+            VLESS_TRANSPORTS[name] = func
+        return func
+
+    return register
+
+
+def vless_security(*names):
+    def register(func):
+        for name in names:
+            VLESS_SECURITIES[name] = func
+        return func
+
+    return register
+
+
+@vless_transport("tcp", "raw")
+def _tcp_settings(protocol):
+    data = protocol.server_data
+    if first(data.get("headerType"), "none") != "http":
+        return {"network": "tcp"}
+
+    request = {"path": [first(data.get("path"), "/")]}
+    if first(data.get("host")):
+        request["headers"] = {"Host": first(data.get("host")).split(",")}
+
+    return {
+        "network": "tcp",
+        "tcpSettings": {"header": {"type": "http", "request": request}},
+    }
+
+
+@vless_transport("ws")
+def _ws_settings(protocol):
+    data = protocol.server_data
+    settings = {"path": first(data.get("path"), "/")}
+    if first(data.get("host")):
+        settings["headers"] = {"Host": first(data.get("host"))}
+
+    return {"network": "ws", "wsSettings": settings}
+
+
+@vless_transport("grpc")
+def _grpc_settings(protocol):
+    return {
+        "network": "grpc",
+        "grpcSettings": {
+            "serviceName": first(protocol.server_data.get("serviceName")),
+            **protocol.tuning["grpc"],
+        },
+    }
+
+
+@vless_transport("h2", "http")
+def _http_settings(protocol):
+    data = protocol.server_data
+    settings = {"path": first(data.get("path"), "/")}
+    if first(data.get("host")):
+        settings["host"] = first(data.get("host")).split(",")
+
+    return {"network": "http", "httpSettings": settings}
+
+
+@vless_transport("httpupgrade")
+def _httpupgrade_settings(protocol):
+    data = protocol.server_data
+    settings = {"path": first(data.get("path"), "/")}
+    if first(data.get("host")):
+        settings["host"] = first(data.get("host"))
+
+    return {"network": "httpupgrade", "httpupgradeSettings": settings}
+
+
+@vless_transport("xhttp", "splithttp")
+def _xhttp_settings(protocol):
+    data = protocol.server_data
+    settings = {
+        "path": first(data.get("path"), "/"),
+        "mode": first(data.get("mode"), "auto"),
+    }
+    if first(data.get("host")):
+        settings["host"] = first(data.get("host"))
+
+    return {"network": "xhttp", "xhttpSettings": settings}
+
+
+@vless_security("none", "")
+def _none_settings(protocol):
+    return {"security": "none"}
+
+
+@vless_security("tls")
+def _tls_settings(protocol):
+    data = protocol.server_data
+    server_name = first(data.get("sni")) or first(data.get("host")).split(",")[0]
+    settings = {
+        "serverName": server_name or protocol.server_address,
+        "allowInsecure": first(data.get("allowInsecure")) in ("1", "true"),
+    }
+    if first(data.get("fp")):
+        settings["fingerprint"] = first(data.get("fp"))
+    if first(data.get("alpn")):
+        settings["alpn"] = first(data.get("alpn")).split(",")
+
+    return {"security": "tls", "tlsSettings": settings}
+
+
+@vless_security("reality")
+def _reality_settings(protocol):
+    data = protocol.server_data
+    return {
+        "security": "reality",
+        "realitySettings": {
+            "show": False,
+            "serverName": first(data.get("sni")),
+            "fingerprint": first(data.get("fp")),
+            "publicKey": first(data.get("pbk")),
+            "shortId": first(data.get("sid")),
+            "spiderX": first(data.get("spx")),
+        },
+    }
+
+
 class ServerProtocolE(BaseServerProtocol):
     NAME = b"\x76\x6c\x65\x73\x73".decode()
+    MUX = True
+    XUDP = True
+
+    def mux(self, concurrency, client="v2fly"):
+        # Vision splices the inner TLS and reality has its own handshake,
+        # neither works under mux.cool
+        flow = first(self.server_data.get("flow"))
+        security = first(self.server_data.get("security"), "none")
+        if flow.startswith("xtls-rprx-vision") or security == "reality":
+            return None
+
+        return super().mux(concurrency, client)
 
     def settings(self):
         return {
@@ -119,12 +518,10 @@ class ServerProtocolE(BaseServerProtocol):
                     "users": [
                         {
                             "id": self.server_uuid,
-                            "encryption": self.server_data.get("encryption")[0],
-                            "flow": (
-                                ""
-                                if self.server_data.get("flow") is None
-                                else self.server_data.get("flow")
+                            "encryption": first(
+                                self.server_data.get("encryption"), "none"
                             ),
+                            "flow": first(self.server_data.get("flow")),
                         }
                     ],
                 }
@@ -132,48 +529,67 @@ class ServerProtocolE(BaseServerProtocol):
         }
 
     def streamSettings(self):
-        network = self.server_data.get("type")[0]
-        security = self.server_data.get("security")[0]
+        network = first(self.server_data.get("type"), "tcp")
+        security = first(self.server_data.get("security"), "none")
 
-        assert network == "grpc", f"TODO: add more {network}"
-        assert security == "reality", f"TODO: add more {security}"
+        assert network in VLESS_TRANSPORTS, f"Unsupported vless transport {network}"
+        assert security in VLESS_SECURITIES, f"Unsupported vless security {security}"
 
         data = dict()
 
-        data.update({"network": network, "security": security})
+        data.update(VLESS_TRANSPORTS[network](self))
+        data.update(VLESS_SECURITIES[security](self))
 
-        if network == "grpc":
-            data.update(
-                {
-                    "grpcSettings": {
-                        "serviceName": self.server_data.get("serviceName")[0],
-                        "mulitMode": False,
-                        "idle_timeout": 60,
-                        "health_check_timeout": 20,
-                        "permit_without_stream": False,
-                        "initial_windows_size": 0,
-                    }
-                }
-            )
+        return data
 
-        if security == "reality":
-            data.update(
-                {
-                    "realitySettings": {
-                        "show": False,
-                        "serverName": self.server_data.get("sni")[0],
-                        "fingerprint": self.server_data.get("fp")[0],
-                        "publicKey": self.server_data.get("pbk")[0],
-                        "shortId": self.server_data.get("sid")[0],
-                        "spiderX": "",
-                    }
-                }
-            )
 
-        return data
+SERVER_PROTOCOLS = [
+    ServerProtocolA,
+    ServerProtocolB,
+    ServerProtocolC,
+    ServerProtocolD,
+    ServerProtocolE,
+]
+
+
+class Balancer(NamedTuple):
+    """
+    How the proxy outbounds of a multi server config are balanced
+    """
+
+    strategy: str = "leastPing"
+    probe_url: str = "https://www.gstatic.com/generate_204"
+    probe_interval: str = "1m"
+
+
+class DnsOptions(NamedTuple):
+    """
+    dns section of a config, see configProjectV.dns()
+    """
+
+    strategy: str = "UseIPv4"
+    domestic: tuple = DNS_DOMESTIC_SERVERS
+    foreign: tuple = DNS_FOREIGN_SERVERS
+
+
+class BuildOptions(NamedTuple):
+    """
+    Per config build options, a cluster can override each of them
+    """
+
+    client: str = "v2fly"
+    balancer: Balancer = Balancer()
+    tuning: str = "default"
+    mux: int = 0
+    dns: Optional[DnsOptions] = None
 
 
 class configProjectV:
+    def __init__(self, routing=None, client="v2fly"):
+        # Loaded on demand when not given, batch builds share one routing
+        self.compiled_routing = routing
+        self.client = client
+
     def inbounds(self, allow_lan=True, port=10809):
         inbound_allow_lan = allow_lan
         inbound_port = port
@@ -206,17 +622,34 @@ class configProjectV:
 
         return data
 
-    def outbounds(self, protocol):
+    def proxy_outbounds(self, protocol, mux=0):
         data = []
 
-        data.append(
-            {
-                "tag": "proxy",
-                "protocol": protocol.NAME,
+        # Several servers are tagged proxy-0, proxy-1... for the balancer
+        protocols = protocol if isinstance(protocol, list) else [protocol]
+        for i, protocol in enumerate(protocols):
+            stream_settings = protocol.streamSettings()
+            if protocol.tuning["sockopt"]:
+                stream_settings["sockopt"] = dict(protocol.tuning["sockopt"])
+
+            outbound = {
+                "tag": "proxy" if len(protocols) == 1 else f"proxy-{i}",
+                "protocol": protocol.outbound(),
                 "settings": protocol.settings(),
-                "streamSettings": protocol.streamSettings(),
+                "streamSettings": stream_settings,
             }
-        )
+
+            mux_settings = protocol.mux(mux, self.client)
+            if mux_settings is not None:
+                outbound["mux"] = mux_settings
+
+            data.append(outbound)
+
+        return data
+
+    def static_outbounds(self):
+        data = []
+
         data.append(
             {
                 "tag": "direct",
@@ -238,67 +671,95 @@ class configProjectV:
 
         return data
 
-    def rules(self):
-        rules_config = load_rules_config()
+    def outbounds(self, protocol, mux=0):
+        return self.proxy_outbounds(protocol, mux) + self.static_outbounds()
 
-        direct_1st = rules_config["direct_1st"]
-        proxy_1st = rules_config["proxy_1st"]
-        direct_2nd = rules_config["direct_2nd"]
-        proxy_2nd = rules_config["proxy_2nd"]
-        proxy_3rd = rules_config["proxy_3rd"]
-
-        data = []
+    def _routing(self):
+        if self.compiled_routing is None:
+            self.compiled_routing = load_routing()
+        return self.compiled_routing
 
-        if len(direct_1st["domain"]) > 0:
-            obj = dict(type="field", outboundTag="direct", domain=direct_1st["domain"])
-            data.append(obj)
+    def rules(self, balancer=None, dns=None):
+        rules = self._routing().rule_dicts()
 
-        if len(proxy_1st["domain"]) > 0:
-            obj = dict(type="field", outboundTag="proxy", domain=proxy_1st["domain"])
-            data.append(obj)
+        if dns is not None:
+            # Foreign DNS queries go through the proxy, not the catch-all direct
+            foreign = [x for x in dns.foreign if _is_ip(x)]
+            if foreign:
+                rule = dict(type="field", outboundTag="proxy", ip=foreign, port="53")
+                rules.insert(0, rule)
 
-        if len(direct_2nd["domain"]) > 0 and len(direct_2nd["source"]) > 0:
-            obj = dict(
-                type="field",
-                outboundTag="direct",
-                domain=direct_2nd["domain"],
-                source=direct_2nd["source"],
-            )
-            data.append(obj)
-
-        if len(proxy_2nd["domain"]) > 0 and len(proxy_2nd["source"]) > 0:
-            obj = dict(
-                type="field",
-                outboundTag="proxy",
-                domain=proxy_2nd["domain"],
-                source=proxy_2nd["source"],
-            )
-            data.append(obj)
+        if balancer is None:
+            return rules
 
-        obj = dict(type="field", outboundTag="direct", domain=["geosite:cn"])
-        data.append(obj)
+        # The proxy rules go to the balancer instead of a single outbound
+        for i, rule in enumerate(rules):
+            if rule.get("outboundTag") == "proxy":
+                rule = {k: v for k, v in rule.items() if k != "outboundTag"}
+                rule["balancerTag"] = BALANCER_TAG
+                rules[i] = rule
 
-        obj = dict(type="field", outboundTag="direct", ip=["geoip:private", "geoip:cn"])
-        data.append(obj)
+        return rules
 
-        obj = dict(
-            type="field", outboundTag="block", domain=["geosite:category-ads-all"]
-        )
-        data.append(obj)
+    def routing(self, balancer=None, dns=None):
+        data = self._routing().to_dict()
+        if balancer is None and dns is None:
+            return data
 
-        if len(proxy_3rd["source"]) > 0:
-            obj = dict(type="field", outboundTag="proxy", source=proxy_3rd["source"])
-            data.append(obj)
+        data["rules"] = self.rules(balancer, dns)
+        if balancer is None:
+            return data
 
-        obj = dict(type="field", outboundTag="direct", port="0-65535")
-        data.append(obj)
+        data["balancers"] = [
+            {
+                "tag": BALANCER_TAG,
+                "selector": ["proxy-"],
+                "strategy": {"type": balancer.strategy},
+            }
+        ]
 
         return data
 
-    def routing(self):
-        rules = self.rules()
+    def observatory(self, balancer):
+        return {
+            "subjectSelector": ["proxy-"],
+            OBSERVATORY_PROBE_KEY[self.client]: balancer.probe_url,
+            "probeInterval": balancer.probe_interval,
+        }
 
-        return {"domainStrategy": "IPIfNonMatch", "rules": rules}
+    def dns(self, dns):
+        # Same split as the routing: what goes direct resolves domestically
+        direct = [
+            entry
+            for rule in self._routing().rules
+            if rule.get("outboundTag") == "direct" and _conditions(rule) == ("domain",)
+            for entry in rule["domain"]
+        ]
+
+        servers = [
+            {
+                "address": address,
+                "port": 53,
+                "domains": direct,
+                "expectIPs": ["geoip:cn"],
+                # Only the direct domains, the rest never reaches them
+                "skipFallback": True,
+            }
+            for address in dns.domestic
+        ]
+        servers += list(dns.foreign)
+
+        data = {
+            "servers": servers,
+            "queryStrategy": dns.strategy,
+            "disableCache": False,
+            "disableFallbackIfMatch": True,
+            "tag": "dns",
+        }
+        if self.client == "xray":
+            data["enableParallelQuery"] = True
+
+        return data
 
 
 def args_parse():
@@ -310,6 +771,18 @@ def args_parse():
         "  # way 2\n"
         "  \033[1;32m$ python3 v2builder.py -i ~/.cache/server01.json -o config.json --allow_lan --http_port=30030\033[0m\n"
         "\n"
+        "  # way 3, pick a server from the catalog of sub2json.py\n"
+        "  \033[1;32m$ python3 v2builder.py --catalog ~/.cache --select region:hk -o config.json\033[0m\n"
+        "\n"
+        "  # way 4, balance several servers in one config\n"
+        "  \033[1;32m$ python3 v2builder.py -i ~/.cache/server01.json ~/.cache/server02.json -o config.json --strategy random\033[0m\n"
+        "\n"
+        "  # way 5, every cluster of the ansible config in one run, saved as DIR/config_{country}.json\n"
+        "  \033[1;32m$ python3 v2builder.py --clusters ~/.config/multi-client-config.yml --outdir DIR --allow_lan\033[0m\n"
+        "\n"
+        "  # way 6, the same packed with deploy.py into one archive for the remote host\n"
+        "  \033[1;32m$ python3 v2builder.py --clusters ~/.config/multi-client-config.yml --bundle bundle.tar.gz --allow_lan\033[0m\n"
+        "\n"
     )
 
     from argparse import ArgumentParser
@@ -325,18 +798,65 @@ def args_parse():
         "-i",
         "--input",
         metavar="server.conf",
-        required=True,
-        help="Path to input server config file",
+        nargs="+",
+        required=False,
+        help="Path to input server config file, several files are balanced",
+    )
+
+    parser.add_argument(
+        "--catalog",
+        metavar="DIR",
+        required=False,
+        help="Path to the servers.jsonl catalog (or its directory) of sub2json.py",
+    )
+
+    parser.add_argument(
+        "--select",
+        metavar="KEY",
+        nargs="+",
+        required=False,
+        help="Server to pick from --catalog, e.g. region:hk, file:server06.json, id:<id>, best,\n"
+        "several keys are balanced",
     )
 
     parser.add_argument(
         "-o",
         "--output",
         metavar="config.json",
-        required=True,
+        required=False,
         help="Path to output client config file",
     )
 
+    batch = parser.add_argument_group("batch Options")
+    batch.add_argument(
+        "--clusters",
+        metavar="FILE",
+        required=False,
+        help="Path to multi-client-config.yml, build the config of every cluster",
+    )
+    batch.add_argument(
+        "--outdir",
+        metavar="DIR",
+        required=False,
+        help="Directory of the config_{country}.json files built by --clusters,\n"
+        "by default the current directory, or a temporary one with --bundle",
+    )
+    batch.add_argument(
+        "--bundle",
+        metavar="FILE",
+        required=False,
+        help="Pack the configs built by --clusters, their manifest and deploy.py\n"
+        "into the FILE tar.gz",
+    )
+    batch.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        default=1,
+        type=int,
+        help="Build the clusters across N processes",
+    )
+
     client = parser.add_argument_group("client Options")
     client.add_argument(
         "--http_port",
@@ -353,12 +873,156 @@ def args_parse():
         "By default, connections are only allowed from localhost.",
     )
 
-    return parser.parse_args()
+    client.add_argument(
+        "--client",
+        choices=list(OBSERVATORY_PROBE_KEY),
+        default="v2fly",
+        help="Client the config is built for, a cluster uses its client: key.\n"
+        "By default, the client is v2fly.",
+    )
 
+    client.add_argument(
+        "--tuning",
+        choices=list(TUNING_PROFILES),
+        default="default",
+        help="Transport tuning profile of the proxy outbounds (gRPC window,\n"
+        "multiMode, keepalive, TCP Fast Open), a cluster uses its tuning: key.\n"
+        "By default, the default profile.",
+    )
 
-def load_rules_config():
-    import os
+    client.add_argument(
+        "--mux",
+        metavar="N",
+        default=0,
+        type=int,
+        help="mux.cool concurrency of the proxy outbounds (plus xudp on xray), a\n"
+        "cluster uses its mux: key. Skipped for shadowsocks, hysteria2, vision\n"
+        "and reality. By default, 0 (off).",
+    )
+
+    client.add_argument(
+        "--compact",
+        action="store_true",
+        help="If set, write the config without indentation (smaller files).",
+    )
+
+    client.add_argument(
+        "--rules_cache",
+        metavar="FILE",
+        required=False,
+        help="Persist the compiled ~/.v2rules.json routing to FILE, reused while\n"
+        "the rules file is unchanged.",
+    )
+
+    dns = parser.add_argument_group("dns Options")
+    dns.add_argument(
+        "--dns",
+        action="store_true",
+        help="If set, add a dns section with caching and domestic/foreign split\n"
+        "servers, a cluster uses its dns: key.",
+    )
+    dns.add_argument(
+        "--dns_strategy",
+        choices=DNS_QUERY_STRATEGIES,
+        default="UseIPv4",
+        help="queryStrategy of the dns section. By default, UseIPv4.",
+    )
+    dns.add_argument(
+        "--dns_domestic",
+        metavar="SERVER",
+        nargs="+",
+        type=str,
+        default=DNS_DOMESTIC_SERVERS,
+        help="Servers for the domains routed direct (geosite:cn and direct rules)",
+    )
+    dns.add_argument(
+        "--dns_foreign",
+        metavar="SERVER",
+        nargs="+",
+        type=str,
+        default=DNS_FOREIGN_SERVERS,
+        help="Servers for every other domain, queried through the proxy",
+    )
+
+    resolve = parser.add_argument_group("resolve Options")
+    resolve.add_argument(
+        "--resolve",
+        action="store_true",
+        help="If set, resolve the server hostnames at build time and pin the IPs\n"
+        "in the outbounds, SNI/serverName keep the hostname.",
+    )
+    resolve.add_argument(
+        "--resolve_cache",
+        metavar="FILE",
+        default=RESOLVE_CACHE_FILE,
+        help=f"Cache of the resolved addresses. By default, {RESOLVE_CACHE_FILE}.",
+    )
+    resolve.add_argument(
+        "--resolve_ttl",
+        metavar="SECONDS",
+        default=RESOLVE_TTL,
+        type=int,
+        help=f"How long a cached address is reused. By default, {RESOLVE_TTL}.",
+    )
+
+    balance = parser.add_argument_group("balancer Options")
+    balance.add_argument(
+        "--strategy",
+        choices=BALANCER_STRATEGIES,
+        default="leastPing",
+        help="Balancer strategy of a config with several servers, a cluster\n"
+        "can override it with its strategy: key. By default, leastPing.",
+    )
+    balance.add_argument(
+        "--probe_url",
+        metavar="URL",
+        default=Balancer().probe_url,
+        help="URL the observatory probes every server with",
+    )
+    balance.add_argument(
+        "--probe_interval",
+        metavar="INTERVAL",
+        default=Balancer().probe_interval,
+        help="Interval between observatory probes, e.g. 30s, 1m",
+    )
+
+    debug = parser.add_argument_group("debug Options")
+    debug.add_argument(
+        "--stats",
+        metavar="FILE",
+        required=False,
+        help="Dump per-stage time, bytes and item counts as JSON to FILE (- for stderr)",
+    )
+    debug.add_argument(
+        "--profile",
+        metavar="FILE",
+        required=False,
+        help="Run under cProfile and save the pstats to FILE",
+    )
+
+    args = parser.parse_args()
+
+    if [bool(args.input), bool(args.catalog), bool(args.clusters)].count(True) != 1:
+        parser.error(
+            "You must specify exactly one of --input, --catalog or --clusters."
+        )
+
+    if not args.clusters and not args.output:
+        parser.error("--output is required with --input or --catalog.")
+
+    if args.jobs < 1:
+        parser.error("--jobs must be a positive integer.")
+
+    if not 0 <= args.mux <= MUX_MAX_CONCURRENCY:
+        parser.error(f"--mux must be in the range of 0 to {MUX_MAX_CONCURRENCY}.")
+
+    if args.catalog and not args.select:
+        parser.error("--select is required with --catalog.")
 
+    return args
+
+
+def load_rules_config():
     default_rules = {
         "direct_1st": {
             "Note": "e.g. domain",
@@ -423,7 +1087,350 @@ def load_rules_config():
     return rules_config
 
 
-def load_server_config(data):
+class CompiledRouting(NamedTuple):
+    """
+    Immutable routing built from ~/.v2rules.json, every config built in the
+    same process shares it: the rules are read-only mappings of tuples and
+    callers get copies of them from rule_dicts()
+    """
+
+    domain_strategy: str
+    rules: tuple
+
+    @classmethod
+    def create(cls, domain_strategy, rules):
+        return cls(
+            domain_strategy,
+            tuple(
+                MappingProxyType(
+                    {k: tuple(v) if isinstance(v, list) else v for k, v in rule.items()}
+                )
+                for rule in rules
+            ),
+        )
+
+    def __reduce__(self):
+        # Mapping proxies do not pickle, the --jobs workers get the rules anew
+        return (CompiledRouting.create, (self.domain_strategy, self.rule_dicts()))
+
+    def rule_dicts(self):
+        return [
+            {k: list(v) if isinstance(v, tuple) else v for k, v in rule.items()}
+            for rule in self.rules
+        ]
+
+    def to_dict(self):
+        return {"domainStrategy": self.domain_strategy, "rules": self.rule_dicts()}
+
+
+def validate_rules_config(rules_config):
+    if not isinstance(rules_config, dict):
+        raise ValueError("rules config should be a dict")
+
+    for section, keys in RULES_SECTIONS.items():
+        if not isinstance(rules_config.get(section), dict):
+            raise ValueError(f"rules config misses the {section} section")
+
+        for key in keys:
+            values = rules_config[section].get(key)
+            if not isinstance(values, list) or not all(
+                isinstance(value, str) for value in values
+            ):
+                raise ValueError(f"{section}.{key} should be a list of strings")
+
+
+def _domain_matcher(entry):
+    kind, sep, value = entry.partition(":")
+    if not sep:
+        # A bare string is a keyword (substring) match
+        return "keyword", entry
+    if kind in DOMAIN_COST:
+        return kind, value
+    return None, entry
+
+
+class DomainCover:
+    """
+    Domain entries already matched, answers whether a new entry can still
+    match anything: domain:a.com covers domain:/full: a.com and its
+    subdomains, a keyword covers every entry containing it
+    """
+
+    def __init__(self) -> None:
+        self.entries = set()
+        self.domains = set()
+        self.keywords = []
+
+    def add(self, entry):
+        kind, value = _domain_matcher(entry)
+        self.entries.add(entry)
+        if kind == "domain":
+            self.domains.add(value)
+        elif kind == "keyword":
+            self.keywords.append(value)
+
+    def covers(self, entry):
+        if entry in self.entries:
+            return True
+
+        kind, value = _domain_matcher(entry)
+        if kind in ("domain", "full"):
+            labels = value.split(".")
+            if any(".".join(labels[i:]) in self.domains for i in range(len(labels))):
+                return True
+        if kind in ("domain", "full", "keyword"):
+            return any(keyword in value for keyword in self.keywords)
+
+        return False
+
+
+def compact_domains(domains):
+    """
+    Drop duplicates and entries covered by another entry of the same list,
+    cheaper matchers first (a rule matches if any entry matches)
+    """
+    # Keywords and then parents, shortest first, so they swallow what they cover
+    order = {"keyword": 0, "domain": 1}
+
+    def key(entry):
+        kind, value = _domain_matcher(entry)
+        return order.get(kind, 2), len(value)
+
+    cover = DomainCover()
+    for entry in sorted(domains, key=key):
+        if not cover.covers(entry):
+            cover.add(entry)
+
+    compacted = [entry for entry in dict.fromkeys(domains) if entry in cover.entries]
+    return sorted(
+        compacted,
+        key=lambda x: DOMAIN_COST.get(_domain_matcher(x)[0], len(DOMAIN_COST)),
+    )
+
+
+def merge_cidrs(addresses):
+    """
+    Collapse overlapping and adjacent IPs/CIDRs, geoip: and other entries
+    are kept as they are
+    """
+    networks, others = {4: [], 6: []}, []
+    for address in dict.fromkeys(addresses):
+        try:
+            network = ipaddress.ip_network(address, strict=False)
+        except ValueError:
+            others.append(address)
+            continue
+        networks[network.version].append(network)
+
+    merged = []
+    for version in (4, 6):
+        for network in ipaddress.collapse_addresses(networks[version]):
+            if network.num_addresses == 1:
+                merged.append(str(network.network_address))
+            else:
+                merged.append(str(network))
+
+    return merged + others
+
+
+def _is_ip(address):
+    try:
+        ipaddress.ip_address(address)
+    except ValueError:
+        return False
+    return True
+
+
+def _conditions(rule):
+    return tuple(k for k in rule if k not in ("type", "outboundTag", "balancerTag"))
+
+
+def _target(rule):
+    return rule.get("outboundTag"), rule.get("balancerTag")
+
+
+def optimize_rules(rules):
+    """
+    Rules are matched in order and the first match wins, so only rewrites
+    that keep every connection on the same outbound are applied:
+
+      1. compact domain lists and merge CIDRs inside each rule
+      2. drop domains an earlier domain-only rule already matches, and the
+         rule itself once nothing is left
+      3. merge adjacent rules with the same target and the same single
+         condition, then order each run of adjacent rules with the same
+         target by match cost
+    """
+    cover = DomainCover()
+    optimized = []
+
+    for rule in rules:
+        rule = dict(rule)
+
+        if "domain" in rule:
+            domains = [
+                x for x in compact_domains(rule["domain"]) if not cover.covers(x)
+            ]
+            if not domains:
+                continue
+            rule["domain"] = domains
+
+        for key in ("ip", "source"):
+            if key in rule:
+                rule[key] = merge_cidrs(rule[key])
+
+        if _conditions(rule) == ("domain",):
+            for entry in rule["domain"]:
+                cover.add(entry)
+
+        previous = optimized[-1] if optimized else None
+        if (
+            previous is not None
+            and _target(previous) == _target(rule)
+            and len(_conditions(rule)) == 1
+            and _conditions(previous) == _conditions(rule)
+            and _conditions(rule)[0] in ("domain", "ip", "source")
+        ):
+            key = _conditions(rule)[0]
+            merged = previous[key] + rule[key]
+            previous[key] = (
+                compact_domains(merged) if key == "domain" else merge_cidrs(merged)
+            )
+            continue
+
+        optimized.append(rule)
+
+    def cost(rule):
+        return max(RULE_COST.get(key, len(RULE_COST)) for key in _conditions(rule))
+
+    ordered, run = [], []
+    for rule in optimized + [None]:
+        if run and (rule is None or _target(rule) != _target(run[0])):
+            ordered += sorted(run, key=cost)
+            run = []
+        if rule is not None:
+            run.append(rule)
+
+    return ordered
+
+
+def _rules_size(rules):
+    entries = sum(
+        len(rule[key])
+        for rule in rules
+        for key in ("domain", "ip", "source")
+        if key in rule
+    )
+    return len(rules), entries
+
+
+def compile_routing(rules_config):
+    validate_rules_config(rules_config)
+
+    direct_1st = rules_config["direct_1st"]
+    proxy_1st = rules_config["proxy_1st"]
+    direct_2nd = rules_config["direct_2nd"]
+    proxy_2nd = rules_config["proxy_2nd"]
+    proxy_3rd = rules_config["proxy_3rd"]
+
+    data = []
+
+    if len(direct_1st["domain"]) > 0:
+        obj = dict(type="field", outboundTag="direct", domain=direct_1st["domain"])
+        data.append(obj)
+
+    if len(proxy_1st["domain"]) > 0:
+        obj = dict(type="field", outboundTag="proxy", domain=proxy_1st["domain"])
+        data.append(obj)
+
+    if len(direct_2nd["domain"]) > 0 and len(direct_2nd["source"]) > 0:
+        obj = dict(
+            type="field",
+            outboundTag="direct",
+            domain=direct_2nd["domain"],
+            source=direct_2nd["source"],
+        )
+        data.append(obj)
+
+    if len(proxy_2nd["domain"]) > 0 and len(proxy_2nd["source"]) > 0:
+        obj = dict(
+            type="field",
+            outboundTag="proxy",
+            domain=proxy_2nd["domain"],
+            source=proxy_2nd["source"],
+        )
+        data.append(obj)
+
+    obj = dict(type="field", outboundTag="direct", domain=["geosite:cn"])
+    data.append(obj)
+
+    obj = dict(type="field", outboundTag="direct", ip=["geoip:private", "geoip:cn"])
+    data.append(obj)
+
+    obj = dict(type="field", outboundTag="block", domain=["geosite:category-ads-all"])
+    data.append(obj)
+
+    if len(proxy_3rd["source"]) > 0:
+        obj = dict(type="field", outboundTag="proxy", source=proxy_3rd["source"])
+        data.append(obj)
+
+    obj = dict(type="field", outboundTag="direct", port="0-65535")
+    data.append(obj)
+
+    rules = optimize_rules(data)
+
+    before, after = _rules_size(data), _rules_size(rules)
+    print(
+        f"Routing rules optimized: {before[0]} rules / {before[1]} entries -> "
+        f"\033[1;32m{after[0]} rules / {after[1]} entries\033[0m"
+    )
+
+    return CompiledRouting.create("IPIfNonMatch", rules)
+
+
+def load_routing(cache_path=None):
+    """
+    Compiled routing of ~/.v2rules.json, cached in memory by the file mtime
+    and size, and optionally persisted to cache_path for the next process
+    """
+    start = time.perf_counter()
+
+    file_path = os.path.expanduser(GLOBAL_RULES_PATH)
+    if not os.path.exists(file_path):
+        load_rules_config()
+
+    stat = os.stat(file_path)
+    key = [ROUTING_CACHE_VERSION, file_path, stat.st_mtime_ns, stat.st_size]
+
+    routing = _ROUTING_CACHE.get(tuple(key))
+    if routing is not None:
+        return routing
+
+    if cache_path:
+        try:
+            with open(os.path.expanduser(cache_path), "r") as f:
+                cached = json.load(f)
+            if cached["key"] == key:
+                routing = CompiledRouting.create(
+                    cached["domainStrategy"], cached["rules"]
+                )
+        except (OSError, ValueError, KeyError):
+            pass
+
+    if routing is None:
+        routing = compile_routing(load_rules_config())
+
+        if cache_path:
+            with open(os.path.expanduser(cache_path), "w") as f:
+                json.dump({"key": key, **routing.to_dict()}, f)
+
+    _ROUTING_CACHE[tuple(key)] = routing
+    STATS.add("rules_load", time.perf_counter() - start, 1)
+
+    return routing
+
+
+def load_server_config(data, tuning="default"):
     assert isinstance(data, dict), "data should be a dict"
 
     server_uuid = data.get("uuid")
@@ -438,17 +1445,854 @@ def load_server_config(data):
     assert isinstance(server_address, str)
     assert isinstance(server_protocol, str)
 
-    for server in [ServerProtocolA, ServerProtocolB, ServerProtocolC, ServerProtocolE]:
+    for server in SERVER_PROTOCOLS:
         if server.NAME == server_protocol:
             print(f"Loading \033[1;32m{server_note}\033[0m server config")
             return server(
-                server_address, int(server_port), server_uuid, server_method, data
+                server_address,
+                int(server_port),
+                server_uuid,
+                server_method,
+                data,
+                tuning,
             )
 
     print(f"Unsupport server protocol: {server_protocol}")
     exit(1)
 
 
+class ServerCatalog:
+    """
+    Reader of the servers.jsonl catalog written by sub2json.py, a server is
+    selected through the index and read with a single seek
+
+    Selection keys:
+      id:<id>            stable server ID
+      file:server06.json the server behind a serverNN.json
+      protocol:<name>    first server of a protocol
+      region:<code>      first server of a region parsed from the note (hk, jp...)
+      best               best server of the ranking written by prober.py
+
+    With a ranking, protocol: and region: pick the best ranked reachable
+    server instead of the first one
+    """
+
+    KEYS = ("id", "file", "protocol", "region")
+
+    def __init__(self, path):
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            path = os.path.join(path, CATALOG_INDEX_FILE)
+        elif path.endswith(CATALOG_FILE):
+            path = os.path.join(os.path.dirname(path), CATALOG_INDEX_FILE)
+
+        with open(path, "r", encoding="utf-8") as f:
+            self.index = json.load(f)
+
+        self.path = os.path.join(os.path.dirname(path), self.index["catalog"])
+
+        try:
+            with open(os.path.join(os.path.dirname(path), RANKING_FILE), "r") as f:
+                ranking = json.load(f)["servers"]
+        except (OSError, ValueError, KeyError):
+            ranking = []
+
+        self.rank = {
+            server["id"]: position
+            for position, server in enumerate(ranking)
+            if server.get("tcp_ms") is not None and server["id"] in self.index["id"]
+        }
+
+    def _resolve(self, key):
+        if key == "best":
+            return min(self.rank, key=self.rank.get) if self.rank else None
+
+        kind, _, value = key.partition(":")
+        if not value:
+            kind, value = "file", key
+
+        assert kind in self.KEYS, f"Unknown catalog key {kind}, use one of {self.KEYS}"
+
+        if kind == "id":
+            return value if value in self.index["id"] else None
+        if kind == "file":
+            return self.index["file"].get(os.path.basename(value))
+
+        ids = self.index[kind].get(value.lower() if kind == "region" else value)
+        if not ids:
+            return None
+
+        ranked = [sid for sid in ids if sid in self.rank]
+        return min(ranked, key=self.rank.get) if ranked else ids[0]
+
+    def get(self, key):
+        sid = self._resolve(key)
+        if sid is None:
+            print(f"No server matches \033[1;31m{key}\033[0m in {self.path}")
+            exit(1)
+
+        offset, length = self.index["id"][sid]
+        with open(self.path, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.read(length).decode("utf-8"))
+
+
+def system_resolve(host):
+    """
+    First address of host from the system resolver, IPv4 preferred
+    """
+    infos = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+    infos.sort(key=lambda info: info[0] != socket.AF_INET)
+    return infos[0][4][0]
+
+
+def pin_address(server, address):
+    """
+    Copy of server with addr pinned to address, the hostname is kept where
+    TLS and reality need it: an empty sni (and vless host) is filled with it
+    """
+    host = server["addr"]
+    pinned = dict(server, addr=address)
+
+    # Neither outbound speaks TLS
+    if server.get("protocol") in (ServerProtocolA.NAME, ServerProtocolB.NAME):
+        return pinned
+
+    if isinstance(server.get("sni"), list):
+        if not first(server.get("sni")):
+            pinned["sni"] = [host]
+        if not first(server.get("host")):
+            pinned["host"] = [host]
+    elif not server.get("sni"):
+        pinned["sni"] = host
+
+    return pinned
+
+
+class AddressResolver:
+    """
+    Resolves server hostnames concurrently at build time and pins the IPs
+    into the servers, answers are cached in a JSON file for ttl seconds.
+    resolve is any callable host -> IP, system_resolve() by default
+    """
+
+    def __init__(self, cache_path=None, ttl=RESOLVE_TTL, jobs=16, resolve=None):
+        self.cache_path = os.path.expanduser(cache_path) if cache_path else None
+        self.ttl = ttl
+        self.jobs = jobs
+        self.resolve = system_resolve if resolve is None else resolve
+        self.cache = {}
+
+        if self.cache_path:
+            try:
+                with open(self.cache_path, "r", encoding="utf-8") as f:
+                    self.cache = json.load(f)
+            except (OSError, ValueError):
+                self.cache = {}
+
+    def _save(self):
+        if not self.cache_path:
+            return
+
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        with open(self.cache_path, "w", encoding="utf-8") as f:
+            json.dump(self.cache, f, indent=4, sort_keys=True)
+
+    def lookup(self, hosts):
+        """
+        {host: IP} of hosts, a host that fails to resolve is left out
+        """
+        now = time.time()
+        self.cache = {
+            host: entry for host, entry in self.cache.items() if entry["expires"] > now
+        }
+
+        missing = sorted({host for host in hosts if host not in self.cache})
+        if missing:
+            from concurrent.futures import ThreadPoolExecutor
+
+            def resolve(host):
+                try:
+                    return host, self.resolve(host), None
+                except (OSError, ValueError) as e:
+                    return host, None, e
+
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                for host, address, error in executor.map(resolve, missing):
+                    if error is not None:
+                        print(f"Failed to resolve \033[1;31m{host}\033[0m: {error}")
+                        continue
+                    self.cache[host] = {"ip": address, "expires": now + self.ttl}
+
+            self._save()
+
+        return {host: self.cache[host]["ip"] for host in hosts if host in self.cache}
+
+    def pin(self, servers):
+        """
+        servers with every hostname pinned, each item is a server dict or a
+        list of them (a balanced cluster)
+        """
+        flat = [
+            x for item in servers for x in (item if isinstance(item, list) else [item])
+        ]
+        hosts = [server["addr"] for server in flat if not _is_ip(server["addr"])]
+        addresses = self.lookup(hosts)
+
+        def pinned(server):
+            address = addresses.get(server["addr"])
+            return server if address is None else pin_address(server, address)
+
+        return [
+            [pinned(x) for x in item] if isinstance(item, list) else pinned(item)
+            for item in servers
+        ]
+
+
+def load_server_file(path):
+    with open(os.path.expanduser(path), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_protocols(server, tuning="default"):
+    """
+    Server protocols of a server dict or a list of them, already loaded
+    protocols are passed through
+    """
+    servers = server if isinstance(server, list) else [server]
+    assert servers, "at least one server is required"
+
+    return [
+        (
+            server
+            if isinstance(server, BaseServerProtocol)
+            else load_server_config(server, tuning)
+        )
+        for server in servers
+    ]
+
+
+def build_sidecar(protocols):
+    """
+    Config of the hysteria2 sidecar of a config, None without hysteria2.
+    There is one sidecar per config, validate_config reports a config with
+    several hysteria2 servers
+    """
+    sidecars = [protocol.sidecar() for protocol in protocols]
+    sidecars = [sidecar for sidecar in sidecars if sidecar is not None]
+
+    return sidecars[0] if sidecars else None
+
+
+def sidecar_path(path):
+    """
+    config_hk.json -> config_hk.hysteria2.json
+    """
+    root, ext = os.path.splitext(path)
+    return (root if ext == ".json" else path) + SIDECAR_SUFFIX
+
+
+def build_config(server, port, allow_lan, routing=None, options=None):
+    """
+    server is a server dict or a list of them, several servers are balanced
+    behind the proxy tag and health checked by the observatory
+    """
+    options = BuildOptions() if options is None else options
+    outbounds_protocol = load_protocols(server, options.tuning)
+    config = configProjectV(routing, options.client)
+
+    balancer = options.balancer if len(outbounds_protocol) > 1 else None
+    data = {
+        "inbounds": config.inbounds(allow_lan, port),
+        "outbounds": config.outbounds(outbounds_protocol, options.mux),
+        "routing": config.routing(balancer, options.dns),
+    }
+    if balancer is not None:
+        data["observatory"] = config.observatory(balancer)
+    if options.dns is not None:
+        data["dns"] = config.dns(options.dns)
+
+    return data
+
+
+def load_clusters_config(path):
+    import yaml
+
+    with open(os.path.expanduser(path), "r", encoding="utf-8") as f:
+        clusters = (yaml.safe_load(f) or {}).get("clusters") or []
+
+    for cluster in clusters:
+        assert cluster.get("country"), f"cluster {cluster.get('name')} has no country"
+        assert isinstance(
+            cluster.get("port"), int
+        ), f"cluster {cluster.get('name')} port should be integer"
+        assert (
+            cluster.get("file") or cluster.get("files") or cluster.get("catalog")
+        ), f"cluster {cluster.get('name')} has neither file, files nor catalog"
+        assert (
+            cluster.get("strategy", "leastPing") in BALANCER_STRATEGIES
+        ), f"cluster {cluster.get('name')} strategy should be one of {BALANCER_STRATEGIES}"
+        assert (
+            cluster.get("tuning", "default") in TUNING_PROFILES
+        ), f"cluster {cluster.get('name')} tuning should be one of {list(TUNING_PROFILES)}"
+        assert (
+            isinstance(cluster.get("mux", 0), int)
+            and 0 <= cluster.get("mux", 0) <= MUX_MAX_CONCURRENCY
+        ), f"cluster {cluster.get('name')} mux should be integer in 0..{MUX_MAX_CONCURRENCY}"
+        assert isinstance(
+            cluster.get("dns", False), (bool, dict)
+        ), f"cluster {cluster.get('name')} dns should be true, false or a mapping"
+        if isinstance(cluster.get("dns"), dict):
+            assert (
+                cluster["dns"].get("strategy", "UseIPv4") in DNS_QUERY_STRATEGIES
+            ), f"cluster {cluster.get('name')} dns strategy should be one of {DNS_QUERY_STRATEGIES}"
+
+    return clusters
+
+
+def dump_config(config, compact=False):
+    """
+    Canonical JSON of a config, the same config always gives the same bytes
+    and so the same sha256
+    """
+    if compact:
+        return json.dumps(config, separators=(",", ":"), sort_keys=True)
+    return json.dumps(config, indent=2, sort_keys=True)
+
+
+class ConfigTemplate:
+    """
+    Config assembled from sections serialized once, only the proxy
+    outbounds and the inbound ports are rendered per server. The output is
+    byte for byte dump_config() of the config build_config() returns
+    """
+
+    PORTS = ("@http_port@", "@socks_port@")
+
+    def __init__(self, routing=None, allow_lan=True, compact=False):
+        self.compact = compact
+        self.config = configProjectV(routing)
+
+        inbounds = self.config.inbounds(allow_lan, 0)
+        for inbound, placeholder in zip(inbounds, self.PORTS):
+            inbound["port"] = placeholder
+        self.inbounds = self._dump(inbounds, 1)
+
+        self.outbounds = [self._dump(x, 2) for x in self.config.static_outbounds()]
+        self.routings = {(None, None): self._dump(self.config.routing(), 1)}
+        self.dns = {}
+
+    def _dump(self, value, level):
+        """
+        value serialized as it would be when nested level deep in the config
+        """
+        if self.compact:
+            return json.dumps(value, separators=(",", ":"), sort_keys=True)
+        return json.dumps(value, indent=2, sort_keys=True).replace(
+            "\n", "\n" + "  " * level
+        )
+
+    def _array(self, items, level):
+        if self.compact:
+            return "[" + ",".join(items) + "]"
+
+        indent = "\n" + "  " * (level + 1)
+        return "[" + indent + ("," + indent).join(items) + "\n" + "  " * level + "]"
+
+    def _object(self, sections):
+        keys = sorted(sections)
+        if self.compact:
+            return "{" + ",".join(f'"{k}":{sections[k]}' for k in keys) + "}"
+        return "{\n" + ",\n".join(f'  "{k}": {sections[k]}' for k in keys) + "\n}"
+
+    def _routing(self, balancer, dns):
+        key = (balancer, dns)
+        if key not in self.routings:
+            self.routings[key] = self._dump(self.config.routing(balancer, dns), 1)
+        return self.routings[key]
+
+    def _dns(self, dns, client):
+        key = (dns, client)
+        if key not in self.dns:
+            config = configProjectV(self.config.compiled_routing, client)
+            self.dns[key] = self._dump(config.dns(dns), 1)
+        return self.dns[key]
+
+    def render(self, server, port, options=None):
+        assert isinstance(port, int), "port should be integer"
+
+        options = BuildOptions() if options is None else options
+        outbounds_protocol = load_protocols(server, options.tuning)
+        balancer = options.balancer
+        if len(outbounds_protocol) == 1:
+            outbounds_protocol, balancer = outbounds_protocol[0], None
+
+        proxies = configProjectV(client=options.client).proxy_outbounds(
+            outbounds_protocol, options.mux
+        )
+        inbounds = self.inbounds
+        for placeholder, value in zip(self.PORTS, (port, port + 1)):
+            inbounds = inbounds.replace(f'"{placeholder}"', str(value))
+
+        sections = {
+            "inbounds": inbounds,
+            "outbounds": self._array(
+                [self._dump(x, 2) for x in proxies] + self.outbounds, 1
+            ),
+            "routing": self._routing(balancer, options.dns),
+        }
+        if balancer is not None:
+            observatory = configProjectV(client=options.client).observatory(balancer)
+            sections["observatory"] = self._dump(observatory, 1)
+        if options.dns is not None:
+            sections["dns"] = self._dns(options.dns, options.client)
+
+        return self._object(sections)
+
+
+def _check_str(errors, where, value):
+    if not isinstance(value, str) or not value:
+        errors.append(f"{where} should be a non-empty string, got {value!r}")
+
+
+def _check_port(errors, where, value):
+    if not isinstance(value, int) or isinstance(value, bool) or not 0 < value < 65536:
+        errors.append(f"{where} should be a port in 1..65535, got {value!r}")
+
+
+def _check_servers(errors, where, servers, secret):
+    if not isinstance(servers, list) or not servers:
+        errors.append(f"{where} should be a non-empty list")
+        return
+
+    for i, server in enumerate(servers):
+        _check_str(errors, f"{where}[{i}].address", server.get("address"))
+        _check_port(errors, f"{where}[{i}].port", server.get("port"))
+        if secret == "users":
+            users = server.get("users")
+            if not isinstance(users, list) or not users:
+                errors.append(f"{where}[{i}].users should be a non-empty list")
+                continue
+            for j, user in enumerate(users):
+                _check_str(errors, f"{where}[{i}].users[{j}].id", user.get("id"))
+        elif secret is not None:
+            _check_str(errors, f"{where}[{i}].{secret}", server.get(secret))
+
+
+def _check_outbound(errors, outbound):
+    where = f"outbound {outbound.get('tag')}"
+    protocol = outbound.get("protocol")
+    settings = outbound.get("settings") or {}
+    stream = outbound.get("streamSettings") or {}
+
+    if protocol == ServerProtocolA.NAME:
+        _check_servers(errors, f"{where} servers", settings.get("servers"), "password")
+        for i, server in enumerate(settings.get("servers") or []):
+            _check_str(errors, f"{where} servers[{i}].method", server.get("method"))
+    elif protocol == ServerProtocolB.NAME:
+        _check_servers(errors, f"{where} vnext", settings.get("vnext"), "users")
+    elif protocol == ServerProtocolC.NAME:
+        _check_servers(errors, f"{where} servers", settings.get("servers"), "password")
+    elif protocol == ServerProtocolE.NAME:
+        _check_servers(errors, f"{where} vnext", settings.get("vnext"), "users")
+        for i, server in enumerate(settings.get("vnext") or []):
+            for j, user in enumerate(server.get("users") or []):
+                for key in ("encryption", "flow"):
+                    if not isinstance(user.get(key), str):
+                        errors.append(
+                            f"{where} vnext[{i}].users[{j}].{key} should be a string"
+                        )
+    elif protocol == "socks":
+        _check_servers(errors, f"{where} servers", settings.get("servers"), None)
+    elif protocol not in ("freedom", "blackhole"):
+        errors.append(f"{where} has an unknown protocol {protocol!r}")
+
+    if stream.get("network") == "grpc":
+        grpc = stream.get("grpcSettings") or {}
+        _check_str(errors, f"{where} grpcSettings.serviceName", grpc.get("serviceName"))
+
+    if stream.get("security") == "tls":
+        tls = stream.get("tlsSettings") or {}
+        _check_str(errors, f"{where} tlsSettings.serverName", tls.get("serverName"))
+    elif stream.get("security") == "reality":
+        reality = stream.get("realitySettings") or {}
+        for key in ("serverName", "fingerprint", "publicKey"):
+            _check_str(errors, f"{where} realitySettings.{key}", reality.get(key))
+        if not isinstance(reality.get("shortId"), str):
+            errors.append(f"{where} realitySettings.shortId should be a string")
+
+
+def validate_config(config):
+    """
+    Errors of a built config (empty when it is fine): required fields per
+    protocol, ports, unique tags and the tags referenced by the routing,
+    balancers and observatory
+    """
+    errors = []
+
+    inbounds = config.get("inbounds") or []
+    outbounds = config.get("outbounds") or []
+    routing = config.get("routing") or {}
+    if not inbounds:
+        errors.append("inbounds should not be empty")
+    if not outbounds:
+        errors.append("outbounds should not be empty")
+
+    ports = {}
+    for inbound in inbounds:
+        where = f"inbound {inbound.get('tag')}"
+        _check_str(errors, f"{where} protocol", inbound.get("protocol"))
+        _check_port(errors, f"{where} port", inbound.get("port"))
+        if inbound.get("port") in ports:
+            errors.append(
+                f"{where} port {inbound['port']} is already used by inbound "
+                f"{ports[inbound['port']]}"
+            )
+        ports[inbound.get("port")] = inbound.get("tag")
+
+    tags = set()
+    hops = 0
+    for outbound in outbounds:
+        tag = outbound.get("tag")
+        if not isinstance(tag, str) or not tag:
+            errors.append(f"outbound {outbound.get('protocol')} has no tag")
+        elif tag in tags:
+            errors.append(f"outbound tag {tag} is used twice")
+        tags.add(tag)
+        _check_outbound(errors, outbound)
+
+        # The hysteria2 sidecar listens in the same network namespace
+        if outbound.get("protocol") == "socks" and HYSTERIA2_SOCKS_PORT in ports:
+            errors.append(
+                f"inbound {ports[HYSTERIA2_SOCKS_PORT]} port {HYSTERIA2_SOCKS_PORT}"
+                " collides with the hysteria2 sidecar"
+            )
+        if outbound.get("protocol") == "socks" and any(
+            server.get("port") == HYSTERIA2_SOCKS_PORT
+            for server in (outbound.get("settings") or {}).get("servers") or []
+        ):
+            hops += 1
+
+    if hops > 1:
+        errors.append(
+            f"{hops} hysteria2 servers share the one hysteria2 sidecar, a config "
+            "supports only one"
+        )
+
+    balancers = set()
+    for balancer in routing.get("balancers") or []:
+        balancers.add(balancer.get("tag"))
+        for prefix in balancer.get("selector") or []:
+            if not any(tag.startswith(prefix) for tag in tags if tag):
+                errors.append(f"balancer {balancer.get('tag')} selects no outbound")
+
+    for i, rule in enumerate(routing.get("rules") or []):
+        if "outboundTag" in rule and rule["outboundTag"] not in tags:
+            errors.append(f"rule {i} routes to unknown outbound {rule['outboundTag']}")
+        elif "balancerTag" in rule and rule["balancerTag"] not in balancers:
+            errors.append(f"rule {i} routes to unknown balancer {rule['balancerTag']}")
+        elif "outboundTag" not in rule and "balancerTag" not in rule:
+            errors.append(f"rule {i} has neither outboundTag nor balancerTag")
+
+    observatory = config.get("observatory")
+    if observatory is not None:
+        for prefix in observatory.get("subjectSelector") or []:
+            if not any(tag.startswith(prefix) for tag in tags if tag):
+                errors.append(f"observatory selector {prefix} matches no outbound")
+
+    dns = config.get("dns")
+    if dns is not None and not dns.get("servers"):
+        errors.append("dns servers should not be empty")
+
+    return errors
+
+
+def validate_sidecar(sidecar):
+    """
+    Errors of a hysteria2 sidecar config
+    """
+    errors = []
+
+    _check_str(errors, "hysteria2 server", sidecar.get("server"))
+    _check_str(errors, "hysteria2 auth", sidecar.get("auth"))
+    _check_str(errors, "hysteria2 tls.sni", (sidecar.get("tls") or {}).get("sni"))
+    _check_str(
+        errors, "hysteria2 socks5.listen", (sidecar.get("socks5") or {}).get("listen")
+    )
+
+    return errors
+
+
+def validate_batch(configs):
+    """
+    {name: errors} of the configs of a batch, {name: config}. Every cluster
+    publishes its inbound ports on the same host, so they must not collide
+    """
+    report = {name: validate_config(config) for name, config in configs.items()}
+
+    owners = {}
+    for name, config in configs.items():
+        for inbound in config.get("inbounds") or []:
+            port = inbound.get("port")
+            if port in owners and owners[port] != name:
+                report[name].append(
+                    f"inbound {inbound.get('tag')} port {port} is already used by "
+                    f"{owners[port]}"
+                )
+            owners.setdefault(port, name)
+
+    return {name: errors for name, errors in report.items() if errors}
+
+
+def report_invalid(report):
+    """
+    Print the validation errors and exit before anything is written
+    """
+    if not report:
+        return
+
+    for name, errors in report.items():
+        for error in errors:
+            print(f"\033[1;31m{name}\033[0m: {error}")
+    print(f"\033[1;31m{len(report)} invalid config(s), nothing was written\033[0m")
+    exit(1)
+
+
+def write_config(path, data):
+    """
+    Write data (str or bytes) unless path already holds it, returns its sha256
+    """
+    raw = data.encode("utf-8") if isinstance(data, str) else data
+    digest = hashlib.sha256(raw).hexdigest()
+
+    try:
+        with open(path, "rb") as f:
+            unchanged = hashlib.sha256(f.read()).hexdigest() == digest
+    except OSError:
+        unchanged = False
+
+    if not unchanged:
+        with open(path, "wb") as f:
+            f.write(raw)
+
+    return digest
+
+
+def _dns_value(key, value):
+    # domestic: and foreign: take a list or a single server
+    if key in ("domestic", "foreign"):
+        return tuple(value) if isinstance(value, list) else (value,)
+    return value
+
+
+def cluster_options(cluster, options):
+    """
+    options with the client:, strategy:, tuning:, mux: and dns: keys of a
+    cluster, dns: is true/false or a mapping of DnsOptions fields
+    """
+    balancer = options.balancer
+    if cluster.get("strategy"):
+        balancer = balancer._replace(strategy=cluster["strategy"])
+
+    dns = options.dns
+    if cluster.get("dns") is False:
+        dns = None
+    elif cluster.get("dns") is True:
+        dns = options.dns or DnsOptions()
+    elif isinstance(cluster.get("dns"), dict):
+        dns = (options.dns or DnsOptions())._replace(
+            **{key: _dns_value(key, value) for key, value in cluster["dns"].items()}
+        )
+
+    return options._replace(
+        client=cluster.get("client", options.client),
+        balancer=balancer,
+        tuning=cluster.get("tuning", options.tuning),
+        mux=cluster.get("mux", options.mux),
+        dns=dns,
+    )
+
+
+def _build_cluster(job):
+    cluster, server, template, options = job
+    options = cluster_options(cluster, options)
+
+    protocols = load_protocols(server, options.tuning)
+    data = template.render(protocols, cluster["port"], options)
+
+    sidecar = build_sidecar(protocols)
+    if sidecar is not None:
+        sidecar = dump_config(sidecar, template.compact)
+
+    return cluster["country"], data, sidecar
+
+
+def build_clusters(
+    clusters,
+    outdir,
+    allow_lan=True,
+    jobs=1,
+    rules_cache=None,
+    options=None,
+    compact=False,
+    resolver=None,
+):
+    """
+    Build the config of every cluster in one process (or a pool of them),
+    the rules and every catalog are loaded once
+
+    A cluster with a files: list, or a list of catalog select: keys, gets
+    one balanced config for all of its servers
+    """
+    options = BuildOptions() if options is None else options
+    template = ConfigTemplate(load_routing(rules_cache), allow_lan, compact)
+
+    catalogs = {}
+    with STATS.stage("server_load") as stage:
+        servers = []
+        for cluster in clusters:
+            if cluster.get("catalog"):
+                path = os.path.expanduser(cluster["catalog"])
+                if path not in catalogs:
+                    catalogs[path] = ServerCatalog(path)
+                select = cluster.get("select") or "best"
+                if isinstance(select, list):
+                    server = [catalogs[path].get(key) for key in select]
+                else:
+                    server = catalogs[path].get(select)
+            elif cluster.get("files"):
+                server = [load_server_file(path) for path in cluster["files"]]
+            else:
+                server = load_server_file(cluster["file"])
+            servers.append(server)
+        stage.add(items=len(servers))
+
+    if resolver is not None:
+        with STATS.stage("resolve") as stage:
+            servers = resolver.pin(servers)
+            stage.add(items=len(resolver.cache))
+
+    work = [
+        (cluster, server, template, options)
+        for cluster, server in zip(clusters, servers)
+    ]
+
+    with STATS.stage("config_build") as stage:
+        if jobs > 1 and len(work) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                results = list(executor.map(_build_cluster, work))
+        else:
+            results = [_build_cluster(job) for job in work]
+        stage.add(items=len(results))
+
+    with STATS.stage("validate") as stage:
+        configs, report = {}, {}
+        for country, data, sidecar in results:
+            name = f"config_{country}.json"
+            if name in configs:
+                report[name] = [f"country {country} is used by several clusters"]
+            configs[name] = json.loads(data)
+            if sidecar is not None:
+                errors = validate_sidecar(json.loads(sidecar))
+                if errors:
+                    report[sidecar_path(name)] = errors
+        for name, errors in validate_batch(configs).items():
+            report.setdefault(name, []).extend(errors)
+        stage.add(items=len(configs))
+    report_invalid(report)
+
+    os.makedirs(outdir, exist_ok=True)
+    with STATS.stage("write") as stage:
+        digests = {}
+        for country, data, sidecar in results:
+            name = f"config_{country}.json"
+            output_file = os.path.join(outdir, name)
+            digests[name] = write_config(output_file, data)
+            stage.add(items=1, nbytes=len(data))
+            print(
+                f"Output file saved at \033[1;32m{os.path.realpath(output_file)}\033[0m"
+                f" (sha256 {digests[name][:12]})"
+            )
+
+            # A stale sidecar config would start a sidecar nobody uses
+            sidecar_file = sidecar_path(output_file)
+            if sidecar is None:
+                if os.path.exists(sidecar_file):
+                    os.remove(sidecar_file)
+                continue
+
+            name = os.path.basename(sidecar_file)
+            digests[name] = write_config(sidecar_file, sidecar)
+            stage.add(items=1, nbytes=len(sidecar))
+            print(
+                f"Sidecar file saved at \033[1;32m{os.path.realpath(sidecar_file)}\033[0m"
+            )
+
+        manifest = "".join(f"{digests[name]}  {name}\n" for name in sorted(digests))
+        with open(os.path.join(outdir, CONFIGS_MANIFEST_FILE), "w") as f:
+            f.write(manifest)
+
+    return digests
+
+
+def _bundle_add(tar, name, raw):
+    # Fixed metadata, the same configs give the same archive
+    info = tarfile.TarInfo(name)
+    info.size = len(raw)
+    info.mode = 0o755 if name.endswith(".py") else 0o644
+    tar.addfile(info, io.BytesIO(raw))
+
+
+def write_bundle(path, clusters, outdir, digests, options=None):
+    """
+    Pack the configs built by build_clusters() into one tar.gz with the
+    manifest of deploy.py (every cluster with the sha256 of its config and
+    sidecar), configs.sha256, the image pins and deploy.py itself. Returns
+    the sha256 of the archive
+    """
+    options = BuildOptions() if options is None else options
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    manifest = {"clusters": []}
+    for cluster in clusters:
+        name = f"config_{cluster['country']}.json"
+        entry = {
+            "name": cluster.get("name", cluster["country"]),
+            "client": cluster_options(cluster, options).client,
+            "country": cluster["country"],
+            "port": cluster["port"],
+            "sha256": digests[name],
+        }
+        if sidecar_path(name) in digests:
+            entry["sidecar_sha256"] = digests[sidecar_path(name)]
+        manifest["clusters"].append(entry)
+
+    files = {BUNDLE_MANIFEST_FILE: dump_config(manifest).encode("utf-8")}
+    for name in sorted(digests) + [CONFIGS_MANIFEST_FILE]:
+        with open(os.path.join(outdir, name), "rb") as f:
+            files[name] = f.read()
+    pins = {entry["client"] for entry in manifest["clusters"]}
+    if any("sidecar_sha256" in entry for entry in manifest["clusters"]):
+        pins.add(BUNDLE_SIDECAR_PIN)
+    for client in sorted(pins):
+        name = os.path.join(BUNDLE_SHA256_DIR, f"{client}.sha256")
+        with open(os.path.join(here, name), "rb") as f:
+            files[name] = f.read()
+    for name in BUNDLE_SCRIPTS:
+        with open(os.path.join(here, name), "rb") as f:
+            files[name] = f.read()
+
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode="w", format=tarfile.PAX_FORMAT) as tar:
+            for name, raw in files.items():
+                _bundle_add(tar, name, raw)
+
+    return write_config(path, buffer.getvalue())
+
+
 def main():
     args = args_parse()
 
@@ -458,17 +2302,96 @@ def main():
     http_port = args.http_port
     allow_lan = args.allow_lan
 
-    with open(input_file, "r", encoding="utf-8") as f:
-        outbounds_protocol = load_server_config(json.load(f))
-
-    with open(output_file, "w") as f:
-        config = {
-            "inbounds": configProjectV().inbounds(allow_lan, http_port),
-            "outbounds": configProjectV().outbounds(outbounds_protocol),
-            "routing": configProjectV().routing(),
-        }
+    options = BuildOptions(
+        client=args.client,
+        balancer=Balancer(args.strategy, args.probe_url, args.probe_interval),
+        tuning=args.tuning,
+        mux=args.mux,
+        dns=(
+            DnsOptions(
+                args.dns_strategy, tuple(args.dns_domestic), tuple(args.dns_foreign)
+            )
+            if args.dns
+            else None
+        ),
+    )
 
-        json.dump(config, f, indent=2)
+    resolver = None
+    if args.resolve:
+        resolver = AddressResolver(args.resolve_cache, args.resolve_ttl)
+
+    with profiled(args.profile):
+        if args.clusters:
+            clusters = load_clusters_config(args.clusters)
+            with tempfile.TemporaryDirectory() as tmpdir:
+                outdir = args.outdir or (tmpdir if args.bundle else ".")
+                digests = build_clusters(
+                    clusters,
+                    outdir,
+                    allow_lan,
+                    args.jobs,
+                    args.rules_cache,
+                    options,
+                    args.compact,
+                    resolver,
+                )
+
+                if args.bundle:
+                    with STATS.stage("bundle") as stage:
+                        digest = write_bundle(
+                            args.bundle, clusters, outdir, digests, options
+                        )
+                        stage.add(items=1, nbytes=os.path.getsize(args.bundle))
+                    print(
+                        f"Bundle saved at \033[1;32m{os.path.realpath(args.bundle)}\033[0m"
+                        f" (sha256 {digest[:12]})"
+                    )
+
+        else:
+            with STATS.stage("server_load") as stage:
+                if args.catalog:
+                    catalog = ServerCatalog(args.catalog)
+                    server = [catalog.get(key) for key in args.select]
+                else:
+                    server = [load_server_file(path) for path in input_file]
+                stage.add(items=len(server))
+
+            if resolver is not None:
+                with STATS.stage("resolve") as stage:
+                    server = resolver.pin([server])[0]
+                    stage.add(items=len(resolver.cache))
+
+            with STATS.stage("config_build") as stage:
+                routing = load_routing(args.rules_cache)
+                template = ConfigTemplate(routing, allow_lan, args.compact)
+                protocols = load_protocols(server, options.tuning)
+                data = template.render(protocols, http_port, options)
+                sidecar = build_sidecar(protocols)
+                stage.add(items=1)
+
+            with STATS.stage("validate") as stage:
+                report = {output_file: validate_config(json.loads(data))}
+                if sidecar is not None:
+                    report[sidecar_path(output_file)] = validate_sidecar(sidecar)
+                stage.add(items=len(report))
+            report_invalid({name: errors for name, errors in report.items() if errors})
+
+            with STATS.stage("write") as stage:
+                digest = write_config(output_file, data)
+                stage.add(items=1, nbytes=len(data))
+                if sidecar is not None:
+                    sidecar = dump_config(sidecar, args.compact)
+                    write_config(sidecar_path(output_file), sidecar)
+                    stage.add(items=1, nbytes=len(sidecar))
+            print(f"Config sha256 \033[1;32m{digest}\033[0m")
+            if sidecar is not None:
+                print(
+                    "hysteria2 sidecar config saved at "
+                    f"\033[1;32m{os.path.realpath(sidecar_path(output_file))}\033[0m"
+                )
+
+    if args.stats:
+        STATS.dump(args.stats)
 
 
 if __name__ == "__main__":